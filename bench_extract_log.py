@@ -0,0 +1,199 @@
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import resource
+import subprocess
+import tempfile
+
+import extract_log
+from logger import log
+
+# Generator defaults; every knob is also a command line option.
+DEFAULTS = {
+    "seed": 1234,
+    "files": 200,
+    "lines": 400,           # lines per file
+    "log_density": 0.08,    # fraction of lines that start a log call
+    "multiline": 0.25,      # fraction of log calls spread over several lines
+    "block_comments": 0.05, # fraction of lines opening a /* ... */ block
+    "escapes": 0.3,         # fraction of strings with \" \\ or \n escapes
+    "macros": 40,           # number of distinct log macro names
+    "dirs": 8,
+}
+
+CODE_LINES = [
+    "int ret = 0;",
+    "if (ret < 0) {",
+    "}",
+    "for (i = 0; i < n; i++) {",
+    "    buf[i] = (uint8_t)(val >> (i * 8));",
+    "return ret;",
+    "memcpy(dst, src, len);",
+    "x = y / z; // ratio",
+    "const char *name = \"plain string (not a call)\";",
+    "char c = '\"';",
+    "static void helper(int a, int b);",
+    "#include <stdio.h>",
+    "#define MAX_BUF 1024",
+]
+
+def macro_names(count):
+    base = ["ALOGE", "ALOGI", "ALOGW", "ALOGD", "ALOGV", "printf", "LOGE", "LOG_ERROR", "MS_LOGI", "FLOGE"]
+    names = base[:count]
+    i = 0
+    while len(names) < count:
+        names.append(f"BENCH_LOG{i}")
+        i += 1
+    return names
+
+def _string(rng, escapes):
+    words = rng.sample(["open", "failed", "buffer", "%d", "%s", "pts", "0x%x", "size", "ret", "(ok)"], 4)
+    text = " ".join(words)
+    if rng.random() < escapes:
+        text += rng.choice(["\\n", "\\\"quoted\\\"", "\\\\", "\\t%d\\n"])
+    return '"' + text + '"'
+
+def generate_corpus(root, params):
+    """Write a deterministic synthetic C/C++ tree under root; returns (files, lines, calls)."""
+    rng = random.Random(params["seed"])
+    names = macro_names(params["macros"])
+    total_lines = 0
+    total_calls = 0
+    paths = []
+    for d in range(params["dirs"]):
+        os.makedirs(os.path.join(root, f"dir{d}", "sub"), exist_ok=True)
+    for n in range(params["files"]):
+        sub = "sub" if n % 3 == 0 else ""
+        ext = rng.choice([".c", ".cpp", ".h"])
+        path = os.path.join(root, f"dir{n % params['dirs']}", sub, f"file{n}{ext}")
+        out = []
+        while len(out) < params["lines"]:
+            r = rng.random()
+            if r < params["log_density"]:
+                name = rng.choice(names)
+                fmt = _string(rng, params["escapes"])
+                total_calls += 1
+                if rng.random() < params["multiline"]:
+                    out.append(f"    {name}({fmt},")
+                    out.append("            arg1, (arg2 + 1),")
+                    out.append("            arg3);")
+                else:
+                    out.append(f"    {name}({fmt}, arg1);")
+            elif r < params["log_density"] + params["block_comments"]:
+                name = rng.choice(names)
+                out.append(f"/* disabled: {name}(\"never\");")
+                out.append(f"   still in the comment {name}(x); */")
+            else:
+                out.append(rng.choice(CODE_LINES))
+        with open(path, "w") as f:
+            f.write("\n".join(out) + "\n")
+        paths.append(path)
+        total_lines += len(out)
+    return paths, total_lines, total_calls
+
+def build_starters(count):
+    patterns = {}
+    starters = extract_log.StarterSet()
+    for name in macro_names(count):
+        extract_log.add_pattern(patterns, starters, name)
+    return patterns, starters
+
+def peak_rss_mb():
+    self_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    child_kb = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return self_kb / 1024.0, child_kb / 1024.0
+
+def _best_of(repeat, fn):
+    best = None
+    result = None
+    for _ in range(repeat):
+        t = time.perf_counter()
+        result = fn()
+        elapsed = time.perf_counter() - t
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+def run_benchmarks(root, paths, total_lines, patterns, starters, jobs, repeat):
+    size = sum(os.path.getsize(p) for p in paths)
+    results = {}
+
+    def scan_all():
+        return sum(len(extract_log.scan_file(p, patterns, starters)) for p in paths)
+    elapsed, matches = _best_of(repeat, scan_all)
+    results["scan_file"] = {"seconds": elapsed, "matches": matches,
+                            "lines_per_s": total_lines / elapsed, "mb_per_s": size / (1 << 20) / elapsed}
+
+    for name, n in (("walk_root_serial", 1), (f"walk_root_jobs{jobs}", jobs)):
+        elapsed, rows = _best_of(repeat, lambda: extract_log.walk_root(root, patterns, starters, n))
+        results[name] = {"seconds": elapsed, "matches": len(rows), "jobs": n,
+                         "lines_per_s": total_lines / elapsed, "mb_per_s": size / (1 << 20) / elapsed}
+    self_mb, child_mb = peak_rss_mb()
+    results["peak_rss_mb"] = {"self": self_mb, "children": child_mb}
+    return results, size
+
+def git_revision():
+    try:
+        here = os.path.dirname(os.path.abspath(__file__))
+        return subprocess.run(["git", "-C", here, "rev-parse", "--short", "HEAD"], check=True,
+                              stdout=subprocess.PIPE, stderr=subprocess.DEVNULL).stdout.decode().strip()
+    except Exception:
+        return ""
+
+def compare(current, baseline_path):
+    with open(baseline_path, "r", encoding="utf-8") as f:
+        baseline = json.load(f)
+    if baseline.get("params") != current["params"]:
+        log("Warning: baseline was generated with different corpus parameters.")
+    for name, res in current["results"].items():
+        old = baseline.get("results", {}).get(name)
+        if not old or "seconds" not in res:
+            continue
+        log(f"{name:24s} {old['seconds']:8.3f}s -> {res['seconds']:8.3f}s  ({old['seconds'] / res['seconds']:.2f}x)")
+
+def main():
+    ap = argparse.ArgumentParser(description="Benchmark extract_log.scan_file/walk_root on a synthetic C/C++ tree.")
+    for key, value in DEFAULTS.items():
+        ap.add_argument("--" + key.replace("_", "-"), type=type(value), default=value)
+    ap.add_argument("--jobs", type=int, default=os.cpu_count() or 1)
+    ap.add_argument("--repeat", type=int, default=3, help="runs per benchmark, best time is kept")
+    ap.add_argument("--corpus", default="", help="keep the generated tree here instead of a temp dir")
+    ap.add_argument("--out", default="bench_extract_log.json", help="JSON results file")
+    ap.add_argument("--baseline", default="", help="earlier results file to compare against")
+    args = ap.parse_args()
+    params = {key: getattr(args, key) for key in DEFAULTS}
+
+    root = args.corpus or tempfile.mkdtemp(prefix="bench_extract_log_")
+    try:
+        paths, total_lines, total_calls = generate_corpus(root, params)
+        log(f"Corpus: {len(paths)} files, {total_lines} lines, {total_calls} log calls in {root}")
+        patterns, starters = build_starters(params["macros"])
+        results, size = run_benchmarks(root, paths, total_lines, patterns, starters, args.jobs, args.repeat)
+    finally:
+        if not args.corpus:
+            shutil.rmtree(root, ignore_errors=True)
+
+    report = {
+        "date": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "revision": git_revision(),
+        "python": sys.version.split()[0],
+        "params": params,
+        "corpus": {"files": len(paths), "lines": total_lines, "calls": total_calls, "bytes": size},
+        "results": results,
+    }
+    for name, res in results.items():
+        if "seconds" in res:
+            log(f"{name:24s} {res['seconds']:8.3f}s  {res['lines_per_s']:12.0f} lines/s  "
+                f"{res['mb_per_s']:7.2f} MB/s  {res['matches']} matches")
+    log(f"Peak RSS: {results['peak_rss_mb']['self']:.1f} MB (workers {results['peak_rss_mb']['children']:.1f} MB)")
+    with open(args.out, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=1)
+    log(f"Results written to {args.out}")
+    if args.baseline:
+        compare(report, args.baseline)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+import sys
+import argparse
+
+import extract_log
+from logger import log
+
+# Differential check of extract_log.analyze_line against the original
+# character-by-character lexer below, on fixed edge cases and optionally on
+# every file of a source tree (extract_log.py --check-lexer).
+
+def analyze_line_reference(line, state):
+    code_chars = []
+    paren_delta = 0
+    i = 0
+    while i < len(line):
+        ch = line[i]
+        nxt = line[i + 1] if i + 1 < len(line) else ""
+        if state["in_block_comment"]:
+            if ch == "*" and nxt == "/":
+                state["in_block_comment"] = False
+                i += 2
+                continue
+            i += 1
+            continue
+        if state["in_string"]:
+            if state["escape"]:
+                state["escape"] = False
+                i += 1
+                continue
+            if ch == "\\":
+                state["escape"] = True
+                i += 1
+                continue
+            if ch == state["in_string"]:
+                state["in_string"] = None
+                i += 1
+                continue
+            i += 1
+            continue
+        if ch == "/" and nxt == "*":
+            state["in_block_comment"] = True
+            i += 2
+            continue
+        if ch == "/" and nxt == "/":
+            break
+        if ch == "\"" or ch == "'":
+            state["in_string"] = ch
+            i += 1
+            continue
+        code_chars.append(ch)
+        if ch == "(":
+            paren_delta += 1
+        elif ch == ")":
+            paren_delta -= 1
+        i += 1
+    if state["in_string"] and not line.rstrip().endswith("\\"):
+        state["in_string"] = None
+        state["escape"] = False
+    return "".join(code_chars), paren_delta, state
+
+# Each case is a sequence of lines lexed with the state carried between them.
+EDGE_CASES = {
+    "escape at end of line": ['ALOGE("abc\\\n', 'def" , x);\n'],
+    "escaped backslash before quote": ['f("a\\\\", (b));\n'],
+    "escaped quote": ['f("say \\"(\\" now", 1);\n'],
+    "comment opener reused as closer": ['a(/*/ still comment */ 1);\n'],
+    "lone /*/": ['x = 1; /*/\n', 'ALOGE("hidden"); */ y(2);\n'],
+    "block comment over lines": ['a(/* open (\n', 'still ( */ b)\n'],
+    "unterminated string": ['ALOGE("oops\n', 'next(line);\n'],
+    "unterminated char": ["c = 'a\n", "f(1);\n"],
+    "quote in char literal": ["c = '\"'; g(\"s\");\n"],
+    "escaped quote in char literal": ["x = '\\''; y('(');\n"],
+    "starter in line comment": ['// ALOGE("x");\n', 'f(); // ) (\n'],
+    "starter in block comment": ['/* ALOGE("x"); */ y();\n'],
+    "starter in string": ['puts("ALOGE(\\"x\\")");\n'],
+    "division": ['a = b / c; f(a / 2);\n'],
+    "no special characters": ['if (ret < 0) {\n', '\n', '}\n'],
+}
+
+def new_state():
+    return {"in_block_comment": False, "in_string": None, "escape": False}
+
+def compare_lines(name, lines, limit):
+    """(name, line_no, line, fast_result, reference_result) for lines where the lexers differ."""
+    mismatches = []
+    fast = new_state()
+    ref = new_state()
+    for i, line in enumerate(lines, 1):
+        a = extract_log.analyze_line(line, fast)
+        b = analyze_line_reference(line, ref)
+        if a[:2] != b[:2] or fast != ref:
+            mismatches.append((name, i, line, (a[0], a[1], dict(fast)), (b[0], b[1], dict(ref))))
+            if len(mismatches) >= limit:
+                break
+            fast = dict(ref)
+    return mismatches
+
+def check_cases(cases=EDGE_CASES, limit=20):
+    mismatches = []
+    for name, lines in cases.items():
+        mismatches.extend(compare_lines(name, lines, limit - len(mismatches)))
+        if len(mismatches) >= limit:
+            break
+    return mismatches
+
+def check_lexer(paths, limit=20):
+    """
+    Run both lexers over every line of paths and return up to limit
+    mismatches as (path, line_no, line, fast_result, reference_result).
+    """
+    mismatches = []
+    for path in paths:
+        try:
+            with open(path, "r", errors="ignore") as f:
+                mismatches.extend(compare_lines(path, f, limit - len(mismatches)))
+        except OSError:
+            continue
+        if len(mismatches) >= limit:
+            break
+    return mismatches
+
+def report(mismatches):
+    for where, i, line, got, want in mismatches:
+        sys.stdout.write(f"{where}:{i}: {line!r}\n  fast:      {got!r}\n  reference: {want!r}\n")
+
+def main():
+    ap = argparse.ArgumentParser(description="Compare extract_log.analyze_line with the reference lexer.")
+    ap.add_argument("--root", default="", help="also check every source file under this tree")
+    args = ap.parse_args()
+    mismatches = check_cases()
+    report(mismatches)
+    log(f"Edge cases: {len(EDGE_CASES)}, mismatches: {len(mismatches)}")
+    if args.root:
+        tree = check_lexer(extract_log.iter_source_files(args.root))
+        report(tree)
+        log(f"Tree {args.root}: mismatches: {len(tree)}")
+        mismatches += tree
+    sys.exit(1 if mismatches else 0)
+
+if __name__ == "__main__":
+    main()
@@ -33,6 +33,23 @@ def should_keep_row(text):
         
     return True
 
+def iter_clean(rows, counts=None):
+    """
+    Yield rows with cleaned text; rows that should not be kept are still
+    yielded, with empty text. counts, if given, gets 'written'/'filtered'.
+    """
+    for row in rows:
+        cleaned_text = clean_text(row['text'])
+        if should_keep_row(cleaned_text):
+            row['text'] = cleaned_text
+            if counts is not None:
+                counts['written'] = counts.get('written', 0) + 1
+        else:
+            row['text'] = ""
+            if counts is not None:
+                counts['filtered'] = counts.get('filtered', 0) + 1
+        yield row
+
 def process_csv(input_path, output_csv_path):
     if not os.path.exists(input_path):
         print(f"Error: Input file not found at {input_path}")
@@ -60,23 +77,12 @@ def process_csv(input_path, output_csv_path):
             writer.writeheader()
 
             print("Processing rows...")
-            for row in reader:
+            counts = {}
+            for row in iter_clean(reader, counts):
                 rows_read += 1
-                original_text = row['text']
-                cleaned_text = clean_text(original_text)
-                
-                if should_keep_row(cleaned_text):
-                    # Update row for CSV
-                    row['text'] = cleaned_text
-                    writer.writerow(row)
-                    
-                    # Write to TXT
-                    
-                    rows_written += 1
-                else:
-                    row['text'] = ""
-                    writer.writerow(row)
-                    rows_filtered += 1
+                writer.writerow(row)
+            rows_written = counts.get('written', 0)
+            rows_filtered = counts.get('filtered', 0)
         
         print("-" * 30)
         print(f"Cleaning Complete:")
@@ -0,0 +1,244 @@
+import os
+import re
+import json
+import zlib
+import random
+import argparse
+from logger import log
+import log_rules
+
+# Groups near-identical templates of the step 4 txt so step 5 only sends one
+# representative per cluster to the LLM; expand_report then copies the
+# representative's verdict to every member.
+
+INPUT_FILE = "/home/bj17300-049u/work/mediahal_wraper/01201605_mediahal_logset_deduplicated.txt"
+REPS_FILE = os.path.splitext(INPUT_FILE)[0] + "_reps.txt"
+CLUSTERS_FILE = os.path.splitext(INPUT_FILE)[0] + "_clusters.json"
+
+# Two templates are merged when the Jaccard similarity of their word tokens
+# (after canonicalization) is at least this.
+THRESHOLD = 0.8
+# MinHash signature = BANDS * ROWS values; with 16x4 a pair at Jaccard 0.8
+# becomes an LSH candidate with probability > 0.999.
+BANDS = 16
+ROWS = 4
+MINHASH_SEED = 1
+_PRIME = (1 << 61) - 1
+
+# printf conversion, e.g. %d %5.2f %-08llx %zu %%
+FORMAT_SPEC_RE = re.compile(r"%[-+ #0']*(?:\d+|\*)?(?:\.(?:\d+|\*))?(?:hh|h|ll|l|L|q|j|z|t)?([diouxXeEfFgGaAcspn%])")
+CANONICAL_SPEC = {
+    "d": "%d", "i": "%d", "u": "%d", "o": "%d",
+    "x": "%x", "X": "%x",
+    "e": "%f", "E": "%f", "f": "%f", "F": "%f", "g": "%f", "G": "%f", "a": "%f", "A": "%f",
+    "s": "%s", "c": "%c", "p": "%p", "n": "%n", "%": "%%",
+}
+FUNC_NAME_RE = re.compile(r"__(?:PRETTY_FUNCTION|FUNCTION|func)__")
+# Leading function name/line printed through a placeholder:
+# "[%s]", "[%s:%d]", "[%s][%d]", "%s()", "%s:", "%s,", "%s ->", "%s:%d:"
+FUNC_PREFIX_RE = re.compile(r"^(?:\[%s(?:[:,]%d)?\](?:\[%d\])?|%s\(\)\s*[:,]?|%s(?:[:,]%d)?\s*[:,]|%s\s*-+>)\s*")
+SPACE_RE = re.compile(r"\s+")
+# Templates whose token difference holds an outcome word (anything a
+# log_rules tier matches, or one of these) are never merged, so a "failed"
+# template cannot hide behind a "succeeded" representative.
+OUTCOME_WORDS = frozenset(["not", "no", "can", "cannot", "unable", "wrong", "lost", "loss", "gap", "unknown", "never"])
+TOKEN_RE = re.compile(r"%\w|\w+")
+
+def canonicalize(text):
+    """Template text with placeholder spelling, function prefixes, case and whitespace normalized."""
+    text = FORMAT_SPEC_RE.sub(lambda m: CANONICAL_SPEC[m.group(1)], text)
+    text = FUNC_NAME_RE.sub("", text)
+    text = SPACE_RE.sub(" ", text).strip()
+    text = FUNC_PREFIX_RE.sub("", text)
+    return text.lower()
+
+def tokens(canon):
+    return frozenset(TOKEN_RE.findall(canon))
+
+def jaccard(a, b):
+    if not a and not b:
+        return 1.0
+    return len(a & b) / len(a | b)
+
+class _OutcomeWords:
+    def __init__(self, rules):
+        self.rules = rules
+        self.memo = {}
+
+    def __contains__(self, token):
+        hit = self.memo.get(token)
+        if hit is None:
+            hit = token in OUTCOME_WORDS or any(self.rules.match(token, tier) for tier in log_rules.TIERS)
+            self.memo[token] = hit
+        return hit
+
+def outcome_differs(a, b, outcome):
+    return any(t in outcome for t in a ^ b)
+
+def _permutations(count, seed=MINHASH_SEED):
+    rng = random.Random(seed)
+    return [(rng.randrange(1, _PRIME), rng.randrange(0, _PRIME)) for _ in range(count)]
+
+def minhash(token_set, perms):
+    hashes = [zlib.crc32(t.encode("utf-8")) for t in token_set]
+    return [min((a * h + b) % _PRIME for h in hashes) for a, b in perms]
+
+class _UnionFind:
+    def __init__(self, n):
+        self.parent = list(range(n))
+
+    def find(self, x):
+        parent = self.parent
+        while parent[x] != x:
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+        return x
+
+    def union(self, a, b):
+        ra, rb = self.find(a), self.find(b)
+        if ra != rb:
+            # Keep the earlier template as root so it becomes the representative.
+            if rb < ra:
+                ra, rb = rb, ra
+            self.parent[rb] = ra
+
+def cluster_texts(texts, threshold=THRESHOLD, bands=BANDS, rows=ROWS):
+    """
+    Cluster templates (in first-seen order). Returns a list of clusters, each
+    a list of indices into texts with the representative (earliest) first,
+    ordered by representative.
+    """
+    outcome = _OutcomeWords(log_rules.RuleSet.load())
+    uf = _UnionFind(len(texts))
+    # Identical canonical forms are merged outright.
+    by_canon = {}
+    for i, text in enumerate(texts):
+        canon = canonicalize(text)
+        first = by_canon.setdefault(canon, i)
+        if first != i:
+            uf.union(first, i)
+
+    # MinHash/LSH over the distinct canonical forms, candidates verified by exact Jaccard.
+    perms = _permutations(bands * rows)
+    keys = list(by_canon.items())
+    token_sets = [tokens(canon) for canon, _ in keys]
+    buckets = {}
+    for k, token_set in enumerate(token_sets):
+        if not token_set:
+            continue
+        sig = minhash(token_set, perms)
+        for band in range(bands):
+            buckets.setdefault((band, tuple(sig[band * rows:(band + 1) * rows])), []).append(k)
+    for members in buckets.values():
+        if len(members) < 2:
+            continue
+        for x in range(1, len(members)):
+            kx = members[x]
+            ix = keys[kx][1]
+            for y in range(x):
+                ky = members[y]
+                iy = keys[ky][1]
+                if uf.find(ix) == uf.find(iy):
+                    continue
+                if (jaccard(token_sets[kx], token_sets[ky]) >= threshold
+                        and not outcome_differs(token_sets[kx], token_sets[ky], outcome)):
+                    uf.union(ix, iy)
+
+    clusters = {}
+    for i in range(len(texts)):
+        clusters.setdefault(uf.find(i), []).append(i)
+    return [clusters[root] for root in sorted(clusters)]
+
+def cluster_file(input_path, reps_path, clusters_path, threshold=THRESHOLD):
+    """
+    Read the deduplicated txt, write one representative per cluster to
+    reps_path and the multi-member clusters to clusters_path.
+    Returns (templates, clusters).
+    """
+    with open(input_path, "r", encoding="utf-8") as f:
+        # Same filtering as llm_analyze_logs
+        texts = [line.strip() for line in f if line.strip()]
+    clusters = cluster_texts(texts, threshold)
+    with open(reps_path, "w", encoding="utf-8") as f:
+        for members in clusters:
+            f.write(texts[members[0]] + "\n")
+    groups = [{"representative": texts[members[0]], "members": [texts[i] for i in members[1:]]}
+              for members in clusters if len(members) > 1]
+    with open(clusters_path, "w", encoding="utf-8") as f:
+        json.dump({"threshold": threshold, "templates": len(texts), "clusters": len(clusters),
+                   "groups": groups}, f, ensure_ascii=False, indent=1)
+    return len(texts), len(clusters)
+
+def load_clusters(clusters_path):
+    """{representative text: [member texts]}"""
+    with open(clusters_path, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    return {g["representative"]: g["members"] for g in data["groups"]}
+
+def expand_report(report_path, clusters_path, out_path=None):
+    """
+    Copy every suspicious representative's entry in an llm_analyze_logs report
+    to the members of its cluster, so later steps see all templates.
+    Rewrites report_path unless out_path is given. Returns entries added.
+    """
+    members_of = load_clusters(clusters_path)
+    out_path = out_path or report_path
+    tmp_path = out_path + ".tmp"
+    added = 0
+    with open(report_path, "r", encoding="utf-8") as f_in, open(tmp_path, "w", encoding="utf-8") as f_out:
+        log_id = content = None
+        pending = []
+
+        def flush():
+            nonlocal added
+            for member, reason in pending:
+                f_out.write(f"Log ID {log_id} (cluster member):\n")
+                f_out.write(f"Content: {member}\n")
+                f_out.write(f"Analysis: {reason}\n")
+                f_out.write("-" * 30 + "\n")
+                added += 1
+            pending.clear()
+
+        for line in f_in:
+            stripped = line.strip()
+            if stripped.startswith("Log ID "):
+                flush()
+                log_id = stripped[len("Log ID "):].rstrip(":")
+            elif stripped.startswith("Content:"):
+                content = stripped[len("Content:"):].strip()
+            elif stripped.startswith("Analysis:") and content is not None:
+                reason = stripped[len("Analysis:"):].strip()
+                pending = [(m, reason) for m in members_of.get(content, [])]
+                content = None
+            f_out.write(line)
+            if stripped == "-" * 30:
+                flush()
+        flush()
+    os.replace(tmp_path, out_path)
+    return added
+
+def main():
+    ap = argparse.ArgumentParser(description="Cluster near-duplicate log templates before LLM analysis.")
+    ap.add_argument("--input", default=INPUT_FILE, help="deduplicated txt (step 4)")
+    ap.add_argument("--reps", default="", help="one representative per cluster (default: <input>_reps.txt)")
+    ap.add_argument("--clusters", default="", help="cluster members (default: <input>_clusters.json)")
+    ap.add_argument("--threshold", type=float, default=THRESHOLD)
+    ap.add_argument("--expand", default="", help="expand this step 5 report to the cluster members instead")
+    args = ap.parse_args()
+    base = os.path.splitext(args.input)[0]
+    clusters_path = args.clusters or base + "_clusters.json"
+
+    if args.expand:
+        log(f"Added {expand_report(args.expand, clusters_path)} cluster member entries to {args.expand}")
+        return
+    if not os.path.exists(args.input):
+        log(f"Error: {args.input} does not exist.")
+        return
+    reps_path = args.reps or base + "_reps.txt"
+    templates, clusters = cluster_file(args.input, reps_path, clusters_path, args.threshold)
+    log(f"{templates} templates in {clusters} clusters ({templates - clusters} merged)")
+    log(f"Representatives written to {reps_path}")
+    log(f"Clusters written to {clusters_path}")
+
+if __name__ == "__main__":
+    main()
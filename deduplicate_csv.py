@@ -1,16 +1,152 @@
 import csv
 import os
 import sys
-from logger import log
+import json
+import zlib
+import heapq
+import shutil
+import tempfile
+from logger import log, log_every
 
 input_file = '/home/bj17300-049u/work/mediahal_wraper/01201605_mediahal_logset_extracted_cleaned.csv'
 output_csv_file = '/home/bj17300-049u/work/mediahal_wraper/01201605_mediahal_logset_extracted_cleaned_deduplicated.csv'
 output_txt_file = '/home/bj17300-049u/work/mediahal_wraper/01201605_mediahal_logset_extracted_cleaned_deduplicated.txt'
-def deduplicate_csv(input_path, output_csv_path, output_txt_path):
-    seen_texts = set()
-    unique_rows = []
+# Unique texts are kept in memory up to about this many MB, then spilled to
+# hash partitions on disk and merged at the end.
+DEDUP_MEMORY_MB = 256
+DEDUP_PARTITIONS = 64
+# Extra columns of the deduplicated csv
+COUNT_FIELD = 'count'
+SOURCES_FIELD = 'sources'
+SOURCES_SEP = ';'
+# Rough per-entry and per-source overhead of the in-memory table, in bytes
+ENTRY_OVERHEAD = 200
+SOURCE_OVERHEAD = 60
+# Progress: every Nth unique text is logged
+UNIQUE_LOG_EVERY = 1000
+
+def _source(row):
+    return f"{row.get('file', '')}:{row.get('line', '')}"
+
+class _Spill:
+    """
+    Hash-partitioned spill files. Each record is one JSON line
+    [seq, count, values, sources] for a text; a text always lands in the
+    same partition, so partitions can be merged independently.
+    """
+    def __init__(self, tmp_dir, partitions):
+        self.tmp_dir = tmp_dir
+        self.paths = [os.path.join(tmp_dir, f"part{i}.jsonl") for i in range(partitions)]
+        self.files = None
+        self.spills = 0
+
+    def write(self, table):
+        if self.files is None:
+            self.files = [open(p, 'w', encoding='utf-8') for p in self.paths]
+        n = len(self.files)
+        for text, entry in table.items():
+            part = zlib.crc32(text.encode('utf-8', errors='surrogatepass')) % n
+            self.files[part].write(json.dumps([text] + entry, ensure_ascii=False) + '\n')
+        self.spills += 1
+
+    def runs(self):
+        """Merge each partition by text and write it back sorted by first-seen order."""
+        for f in self.files:
+            f.close()
+        runs = []
+        for path in self.paths:
+            merged = {}
+            with open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    text, seq, count, values, sources = json.loads(line)
+                    entry = merged.get(text)
+                    if entry is None:
+                        merged[text] = [seq, count, values, sources]
+                    else:
+                        # Spills are appended in input order, so the first
+                        # record holds the first row and sources stay in order.
+                        entry[1] += count
+                        entry[3].extend(sources)
+            os.remove(path)
+            run_path = path + '.run'
+            with open(run_path, 'w', encoding='utf-8') as f:
+                for text, entry in sorted(merged.items(), key=lambda kv: kv[1][0]):
+                    f.write(json.dumps([entry[0], text] + entry[1:], ensure_ascii=False) + '\n')
+            runs.append(run_path)
+        return runs
+
+def _read_run(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            yield json.loads(line)
+
+def write_unique(rows, fieldnames, output_csv_path, output_txt_path,
+                 memory_mb=None, partitions=DEDUP_PARTITIONS):
+    """
+    Deduplicate rows (dicts) on their 'text', keeping the first row of each
+    text plus its occurrence count and file:line sources. When the unique
+    table grows past memory_mb it is spilled to disk, so memory stays
+    bounded on large logsets. Outputs are in first-seen order.
+    Returns (total_rows, unique_rows).
+    """
+    if memory_mb is None:
+        memory_mb = DEDUP_MEMORY_MB
+    budget = int(memory_mb * (1 << 20))
+    table = {}  # text -> [seq, count, values, sources]
+    used = 0
     total_rows = 0
-    
+    spill = None
+    tmp_dir = None
+    try:
+        for row in rows:
+            total_rows += 1
+            text_content = row['text']
+            source = _source(row)
+            entry = table.get(text_content)
+            if entry is None:
+                values = [row.get(k, '') for k in fieldnames]
+                table[text_content] = [total_rows, 1, values, [source]]
+                used += ENTRY_OVERHEAD + len(text_content) + sum(len(v) for v in values if v)
+                if spill is None:
+                    log_every("dedup.unique", UNIQUE_LOG_EVERY, "Unique row found: %s", text_content)
+            else:
+                entry[1] += 1
+                entry[3].append(source)
+            used += SOURCE_OVERHEAD + len(source)
+            if used > budget:
+                if spill is None:
+                    tmp_dir = tempfile.mkdtemp(prefix='dedup_', dir=os.path.dirname(os.path.abspath(output_csv_path)))
+                    spill = _Spill(tmp_dir, partitions)
+                    log(f"Dedup table over {memory_mb} MB, spilling to {tmp_dir}")
+                spill.write(table)
+                table = {}
+                used = 0
+
+        if spill is None:
+            entries = ([seq, text] + rest for text, (seq, *rest) in table.items())
+        else:
+            spill.write(table)
+            table = {}
+            log(f"Merging {spill.spills} spills over {partitions} partitions...")
+            entries = heapq.merge(*[_read_run(p) for p in spill.runs()], key=lambda e: e[0])
+
+        unique_count = 0
+        with open(output_csv_path, 'w', encoding='utf-8', newline='') as f_out, \
+                open(output_txt_path, 'w', encoding='utf-8', newline='') as f_txt_out:
+            writer = csv.writer(f_out)
+            writer.writerow(list(fieldnames) + [COUNT_FIELD, SOURCES_FIELD])
+            for seq, text_content, count, values, sources in entries:
+                writer.writerow(values + [count, SOURCES_SEP.join(sources)])
+                # 去重
+                f_txt_out.write(text_content + '\n')
+                unique_count += 1
+        log(f"Wrote {unique_count} unique rows to output file.")
+    finally:
+        if tmp_dir:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+    return total_rows, unique_count
+
+def deduplicate_csv(input_path, output_csv_path, output_txt_path):
     if not os.path.exists(input_path):
         log(f"Error: Input file not found at {input_path}")
         return
@@ -19,8 +155,7 @@ def deduplicate_csv(input_path, output_csv_path, output_txt_path):
         # Increase field size limit just in case logs are very long
         csv.field_size_limit(sys.maxsize)
         
-        with open(input_path, 'r', encoding='utf-8', newline='') as f_in, \
-             open(output_txt_path, 'w', encoding='utf-8', newline='') as f_txt_out:
+        with open(input_path, 'r', encoding='utf-8', newline='') as f_in:
             reader = csv.DictReader(f_in)
             fieldnames = reader.fieldnames
             
@@ -29,30 +164,13 @@ def deduplicate_csv(input_path, output_csv_path, output_txt_path):
                  return
 
             log("Processing...")
-            for row in reader:
-                total_rows += 1
-                text_content = row['text']
-                
-                # Check for duplicates
-                if text_content not in seen_texts:
-                    log(f"Unique row found: {text_content}")
-                    seen_texts.add(text_content)
-                    unique_rows.append(row)
-                    # 去重
-                    f_txt_out.write(text_content + '\n')
-
-        
-        log(f"Writing {len(unique_rows)} unique rows to output file...")
-        with open(output_csv_path, 'w', encoding='utf-8', newline='') as f_out:
-            writer = csv.DictWriter(f_out, fieldnames=fieldnames)
-            writer.writeheader()
-            writer.writerows(unique_rows)
+            total_rows, unique_count = write_unique(reader, fieldnames, output_csv_path, output_txt_path)
             
         log("-" * 30)
         log(f"Processing Complete:")
         log(f"Total input rows: {total_rows}")
-        log(f"Unique rows:      {len(unique_rows)}")
-        log(f"Duplicates removed: {total_rows - len(unique_rows)}")
+        log(f"Unique rows:      {unique_count}")
+        log(f"Duplicates removed: {total_rows - unique_count}")
         log(f"Output csv saved to: {output_csv_path}")
         log(f"Output txt saved to: {output_txt_path}")
 
@@ -3,6 +3,13 @@ import re
 import argparse
 import sys
 import csv
+import json
+import hashlib
+import io
+import mmap
+import subprocess
+import time
+from concurrent.futures import ProcessPoolExecutor
 from logger import log
 def build_patterns():
     # names = [
@@ -48,15 +55,92 @@ def build_patterns():
     log(f"Extracted {len(names)} log print patterns.")
     log(f"First patterns: {names}")
     compiled = {}
-    starters = {}
+    starters = StarterSet()
     for n in names:
-        if n == "fprintf":
-            compiled[n] = re.compile(r"\bfprintf\s*\(\s*stderr\s*,.*\)\s*;", re.IGNORECASE)
-        else:
-            compiled[n] = re.compile(r"\b" + n + r"\s*\(.*\)\s*;", re.IGNORECASE)
-        starters[n] = re.compile(r"\b" + n + r"\s*\(", re.IGNORECASE)
+        add_pattern(compiled, starters, n)
     return compiled, starters
 
+def add_pattern(compiled, starters, n):
+    if n == "fprintf":
+        compiled[n] = re.compile(r"\bfprintf\s*\(\s*stderr\s*,.*\)\s*;", re.IGNORECASE)
+    else:
+        compiled[n] = re.compile(r"\b" + n + r"\s*\(.*\)\s*;", re.IGNORECASE)
+    starters[n] = re.compile(r"\b" + n + r"\s*\(", re.IGNORECASE)
+
+IDENT_CALL_RE = re.compile(r"\b(\w+)\s*\(")
+
+class StarterSet(dict):
+    """
+    name -> compiled starter regex, plus a combined matcher so that
+    find_start needs one pass over the line instead of one search per name.
+    Names that are plain identifiers are looked up from a single
+    identifier scan; anything else goes into one alternation.
+    """
+    def __setitem__(self, name, rx):
+        super().__setitem__(name, rx)
+        self._matcher = None
+        self.__dict__.pop("_byte_filter", None)
+
+    def _build(self):
+        by_ident = {}
+        others = []
+        for idx, (name, rx) in enumerate(self.items()):
+            if re.fullmatch(r"\w+", name):
+                by_ident.setdefault(name.lower(), []).append((idx, name, rx))
+            else:
+                others.append((idx, name, rx))
+        other_rx = None
+        if others:
+            other_rx = re.compile("|".join("(?:" + rx.pattern + ")" for _, _, rx in others), re.IGNORECASE)
+        self._matcher = (by_ident, others, other_rx)
+        return self._matcher
+
+    def byte_filter(self):
+        """
+        Bytes regex that hits wherever any starter literal occurs, for
+        skipping files without decoding them. Only the bare name is matched:
+        the lexer drops comments before looking for starters, so
+        'ALOGE /* c */ ("hi")' must still get through. It is meant for
+        lowercased data (a case-sensitive search of lowered bytes is far
+        faster than re.IGNORECASE). None when the names can't be expressed
+        as ASCII literals (then every file has to be scanned).
+        """
+        if "_byte_filter" not in self.__dict__:
+            rx = None
+            names = list(self.keys())
+            if names and all(re.fullmatch(r"[A-Za-z0-9_]+", n) for n in names):
+                rx = re.compile(b"|".join(re.escape(n.lower().encode("ascii")) for n in names))
+            self._byte_filter = rx
+        return self._byte_filter
+
+    def search(self, code_line):
+        by_ident, others, other_rx = getattr(self, "_matcher", None) or self._build()
+        best = None
+        if by_ident:
+            for m in IDENT_CALL_RE.finditer(code_line):
+                cands = by_ident.get(m.group(1).lower())
+                if not cands:
+                    continue
+                # Verify with the per-name regex so IGNORECASE semantics stay exact.
+                for idx, name, rx in cands:
+                    if rx.match(code_line, m.start()):
+                        best = (m.start(), idx, name)
+                        break
+                if best:
+                    break
+        if other_rx is not None:
+            m = other_rx.search(code_line)
+            if m:
+                for idx, name, rx in others:
+                    if rx.match(code_line, m.start()):
+                        # On a tie the original loop kept the name listed first.
+                        if best is None or (m.start(), idx) < best[:2]:
+                            best = (m.start(), idx, name)
+                        break
+        if best is None:
+            return None, None
+        return best[2], best[0]
+
 def is_source_file(path):
     exts = {".c", ".cc", ".cpp", ".h", ".hpp", ".cxx"}
     _, ext = os.path.splitext(path)
@@ -68,60 +152,90 @@ def should_skip_line(line):
         return True
     return False
 
+# Next character that can change the lexer state outside comments/strings,
+# and the characters that matter inside each kind of literal.
+CODE_SPECIAL_RE = re.compile(r"[/\"']")
+STRING_SPECIAL_RE = {"\"": re.compile(r'[\\"]'), "'": re.compile(r"[\\']")}
+
 def analyze_line(line, state):
-    code_chars = []
-    paren_delta = 0
+    """
+    Strip comments and string/char literals from one line of C/C++.
+    Returns (code, paren_delta, state); state carries block comments and
+    open literals across lines. Jumps between significant characters
+    instead of walking the line one character at a time; see
+    check_lexer.analyze_line_reference for the character-by-character
+    definition.
+    """
+    in_block = state["in_block_comment"]
+    quote = state["in_string"]
+    escape = state["escape"]
+    if not in_block and not quote and not CODE_SPECIAL_RE.search(line):
+        return line, line.count("(") - line.count(")"), state
+    parts = []
+    n = len(line)
     i = 0
-    while i < len(line):
-        ch = line[i]
-        nxt = line[i + 1] if i + 1 < len(line) else ""
-        if state["in_block_comment"]:
-            if ch == "*" and nxt == "/":
-                state["in_block_comment"] = False
-                i += 2
-                continue
-            i += 1
+    while i < n:
+        if in_block:
+            j = line.find("*/", i)
+            if j < 0:
+                i = n
+                break
+            in_block = False
+            i = j + 2
             continue
-        if state["in_string"]:
-            if state["escape"]:
-                state["escape"] = False
-                i += 1
-                continue
-            if ch == "\\":
-                state["escape"] = True
+        if quote:
+            if escape:
+                escape = False
                 i += 1
                 continue
-            if ch == state["in_string"]:
-                state["in_string"] = None
-                i += 1
-                continue
-            i += 1
+            m = STRING_SPECIAL_RE[quote].search(line, i)
+            if not m:
+                i = n
+                break
+            i = m.end()
+            if m.group() == "\\":
+                escape = True
+            else:
+                quote = None
             continue
-        if ch == "/" and nxt == "*":
-            state["in_block_comment"] = True
-            i += 2
-            continue
-        if ch == "/" and nxt == "/":
+        m = CODE_SPECIAL_RE.search(line, i)
+        if not m:
+            parts.append(line[i:])
+            i = n
             break
-        if ch == "\"" or ch == "'":
-            state["in_string"] = ch
-            i += 1
+        j = m.start()
+        if j > i:
+            parts.append(line[i:j])
+        ch = m.group()
+        if ch == "/":
+            nxt = line[j + 1:j + 2]
+            if nxt == "*":
+                in_block = True
+                i = j + 2
+                continue
+            if nxt == "/":
+                i = n
+                break
+            parts.append("/")
+            i = j + 1
             continue
-        code_chars.append(ch)
-        if ch == "(":
-            paren_delta += 1
-        elif ch == ")":
-            paren_delta -= 1
-        i += 1
-    if state["in_string"] and not line.rstrip().endswith("\\"):
-        state["in_string"] = None
-        state["escape"] = False
-    return "".join(code_chars), paren_delta, state
+        quote = ch
+        i = j + 1
+    if quote and not line.rstrip().endswith("\\"):
+        quote = None
+        escape = False
+    state["in_block_comment"] = in_block
+    state["in_string"] = quote
+    state["escape"] = escape
+    code = "".join(parts)
+    return code, code.count("(") - code.count(")"), state
 
 def count_parens(code_line):
     return code_line.count("(") - code_line.count(")")
 
 def find_start(code_line, starters):
+    if isinstance(starters, StarterSet):
+        return starters.search(code_line)
     best_name = None
     best_pos = None
     for name, rx in starters.items():
@@ -134,68 +248,840 @@ def find_start(code_line, starters):
 
 def scan_file(path, patterns, starters):
     results = []
+    try:
+        with open(path, "r", errors="ignore") as f:
+            for row in scan_lines(path, f, starters):
+                results.append(row)
+    except Exception:
+        pass
+    return results
+
+def decode_lines(data):
+    """Lines of raw file bytes, decoded as open(path, "r", errors="ignore") would."""
+    return io.TextIOWrapper(io.BytesIO(data), errors="ignore").readlines()
+
+def scan_decoded(path, lines, starters):
+    """scan_file() over lines already read and decoded."""
+    results = []
+    try:
+        for row in scan_lines(path, lines, starters):
+            results.append(row)
+    except Exception:
+        pass
+    return results
+
+def _timed(fn, timings, key):
+    def wrapper(*args):
+        t = time.perf_counter()
+        try:
+            return fn(*args)
+        finally:
+            timings[key] += time.perf_counter() - t
+    return wrapper
+
+def scan_lines(path, lines, starters, timings=None):
+    """
+    Yield (path, line, style, text) for each complete log call in lines.
+    With a timings dict, time spent lexing and matching is added to its
+    "lex" and "match" entries.
+    """
+    lex = analyze_line
+    match = find_start
+    if timings is not None:
+        lex = _timed(analyze_line, timings, "lex")
+        match = _timed(find_start, timings, "match")
     state = {"in_block_comment": False, "in_string": None, "escape": False}
     in_call = False
     call_name = None
     call_line = None
     buffer = []
     paren_balance = 0
-    try:
+    for i, line in enumerate(lines, 1):
+        code_line, delta, state = lex(line, state)
+        if not in_call:
+            if should_skip_line(code_line):
+                continue
+            name, pos = match(code_line, starters)
+            if not name:
+                continue
+            in_call = True
+            call_name = name
+            call_line = i
+            buffer = [line.rstrip("\n")]
+            paren_balance = count_parens(code_line[pos:])
+            if ";" in code_line and paren_balance <= 0:
+                yield (path, call_line, call_name, " ".join(buffer).strip())
+                in_call = False
+                call_name = None
+                call_line = None
+                buffer = []
+                paren_balance = 0
+        else:
+            buffer.append(line.rstrip("\n"))
+            paren_balance += count_parens(code_line)
+            if ";" in code_line and paren_balance <= 0:
+                yield (path, call_line, call_name, " ".join(buffer).strip())
+                in_call = False
+                call_name = None
+                call_line = None
+                buffer = []
+                paren_balance = 0
+            elif len(buffer) > 50:
+                in_call = False
+                call_name = None
+                call_line = None
+                buffer = []
+                paren_balance = 0
+
+# Same shape extract_log_print_patterns.py looks for: NAME( ... "
+CANDIDATE_CALL_RE = re.compile(r'([a-zA-Z_][a-zA-Z0-9_]*)\s*\([^)]*"')
+DEFINE_RE = re.compile(r"^\s*#\s*define\s+([A-Za-z_]\w*)\(([^)]*)\)(.*)$")
+
+def discover_lines(path, lines):
+    """
+    Discovery data for one file: candidate log macro names (NAME(..."
+    on lines mentioning "log", like the grep -i log step), every name called
+    (split calls and macro format strings included, so wrapper call sites
+    are not missed), and function-like #defines with the names their body
+    calls.
+    """
+    candidates = {}
+    calls = set()
+    defines = {}
+    define_name = None
+    define_body = []
+    for i, line in enumerate(lines, 1):
+        if define_name is None:
+            m = DEFINE_RE.match(line)
+            if m:
+                define_name = m.group(1)
+                args = {a.strip() for a in m.group(2).split(",")}
+                define_body = [m.group(3)]
+        else:
+            define_body.append(line)
+        if define_name is not None and not line.rstrip().endswith("\\"):
+            callees = [c for c in IDENT_CALL_RE.findall(" ".join(define_body))
+                       if c != define_name and c not in args]
+            if callees:
+                defines[define_name] = callees
+            define_name = None
+        if "(" not in line:
+            continue
+        calls.update(IDENT_CALL_RE.findall(line))
+        if '"' not in line:
+            continue
+        names = CANDIDATE_CALL_RE.findall(line)
+        if names and "log" in line.lower():
+            for name in names:
+                entry = candidates.get(name)
+                if entry:
+                    entry[0] += 1
+                else:
+                    candidates[name] = [1, f"{path}:{i}"]
+    return {"candidates": candidates, "calls": sorted(calls), "defines": defines}
+
+def resolve_wrappers(defines, starters):
+    """
+    Follow #define chains to known starters: {wrapper: macro it calls} for
+    every define whose body calls a starter or another resolved wrapper.
+    """
+    known = {n.lower() for n in starters}
+    wrappers = {}
+    changed = True
+    while changed:
+        changed = False
+        for name in sorted(defines):
+            if name.lower() in known:
+                continue
+            for callee in defines[name]:
+                if callee.lower() in known:
+                    wrappers[name] = callee
+                    known.add(name.lower())
+                    changed = True
+                    break
+    return wrappers
+
+# Always pruned unless an ignore file re-includes them with "!". The build
+# output and repo-tool directories only at the top of the tree.
+DEFAULT_IGNORE = [".git/", ".svn/", "/.repo/", "/out/"]
+# Read from the scan root (or --ignore-file) on top of any .gitignore files.
+PROJECT_IGNORE_FILE = ".extractlogignore"
+
+def _glob_to_regex(pat):
+    i = 0
+    out = []
+    while i < len(pat):
+        c = pat[i]
+        if pat.startswith("**/", i):
+            out.append("(?:.*/)?")
+            i += 3
+        elif pat.startswith("/**", i) and i + 3 == len(pat):
+            out.append("/.*")
+            i += 3
+        elif pat.startswith("**", i):
+            out.append(".*")
+            i += 2
+        elif c == "*":
+            out.append("[^/]*")
+            i += 1
+        elif c == "?":
+            out.append("[^/]")
+            i += 1
+        elif c == "[":
+            j = pat.find("]", i + 1)
+            if j < 0:
+                out.append(re.escape(c))
+                i += 1
+            else:
+                body = pat[i + 1:j]
+                if body.startswith("!"):
+                    body = "^" + body[1:]
+                out.append("[" + body.replace("\\", "\\\\") + "]")
+                i = j + 1
+        else:
+            out.append(re.escape(c))
+            i += 1
+    return re.compile("".join(out))
+
+class IgnoreRules:
+    """
+    .gitignore-style rules: '#' comments, '!' negation, trailing '/' for
+    directories only, patterns with a '/' anchored to the file's directory,
+    '*', '?', '[...]' and '**'. The last matching rule wins.
+    """
+    def __init__(self, lines=(), base=""):
+        self.base = base
+        self.rules = []
+        for line in lines:
+            line = line.rstrip("\n").rstrip()
+            if not line or line.startswith("#"):
+                continue
+            negate = line.startswith("!")
+            if negate:
+                line = line[1:]
+            dir_only = line.endswith("/")
+            line = line.rstrip("/")
+            anchored = "/" in line
+            line = line.lstrip("/")
+            if line:
+                self.rules.append((_glob_to_regex(line), negate, dir_only, anchored))
+
+    @classmethod
+    def from_file(cls, path, base=""):
         with open(path, "r", errors="ignore") as f:
-            for i, line in enumerate(f, 1):
-                code_line, delta, state = analyze_line(line, state)
-                if not in_call:
-                    if should_skip_line(code_line):
+            return cls(f.readlines(), base)
+
+    def match(self, rel, is_dir):
+        """True/False if a rule decides rel (relative to the scan root), else None."""
+        if self.base:
+            if not rel.startswith(self.base + "/"):
+                return None
+            rel = rel[len(self.base) + 1:]
+        name = rel.rsplit("/", 1)[-1]
+        decision = None
+        for rx, negate, dir_only, anchored in self.rules:
+            if dir_only and not is_dir:
+                continue
+            if rx.fullmatch(rel if anchored else name):
+                decision = not negate
+        return decision
+
+def _is_ignored(rule_sets, rel, is_dir):
+    ignored = False
+    for rules in rule_sets:
+        decision = rules.match(rel, is_dir)
+        if decision is not None:
+            ignored = decision
+    return ignored
+
+def _base_rules(root, ignore_file=None):
+    rules = [IgnoreRules(DEFAULT_IGNORE)]
+    ignore_file = ignore_file or os.path.join(root, PROJECT_IGNORE_FILE)
+    if os.path.isfile(ignore_file):
+        rules.append(IgnoreRules.from_file(ignore_file))
+    return rules
+
+def iter_source_files(root, stats=None, ignore_file=None, use_gitignore=True,
+                      max_size=0, follow_links=False):
+    """
+    Yield source files under root in os.walk order, pruning whole
+    directories that DEFAULT_IGNORE, the project ignore file or (with
+    use_gitignore) .gitignore files exclude. Files bigger than max_size
+    bytes (if > 0) are left out. With follow_links, symlinked directories
+    are entered once and loops are skipped. Pruning counts go to stats.
+    """
+    if stats is None:
+        stats = new_scan_stats()
+    base_rules = _base_rules(root, ignore_file)
+    seen_dirs = set()
+    if follow_links:
+        try:
+            st = os.stat(root)
+            seen_dirs.add((st.st_dev, st.st_ino))
+        except OSError:
+            pass
+    stack = [(root, "", base_rules)]
+    while stack:
+        dirpath, rel_dir, rule_sets = stack.pop()
+        try:
+            with os.scandir(dirpath) as it:
+                entries = list(it)
+        except OSError:
+            continue
+        if use_gitignore and any(e.name == ".gitignore" for e in entries):
+            try:
+                rule_sets = rule_sets + [IgnoreRules.from_file(os.path.join(dirpath, ".gitignore"), rel_dir)]
+            except OSError:
+                pass
+        subdirs = []
+        for entry in entries:
+            rel = rel_dir + "/" + entry.name if rel_dir else entry.name
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                is_dir = False
+            if is_dir:
+                if _is_ignored(rule_sets, rel, True):
+                    stats["dirs_pruned"] += 1
+                    continue
+                if entry.is_symlink():
+                    if not follow_links:
                         continue
-                    name, pos = find_start(code_line, starters)
-                    if not name:
+                try:
+                    st = entry.stat()
+                except OSError:
+                    continue
+                if follow_links:
+                    key = (st.st_dev, st.st_ino)
+                    if key in seen_dirs:
+                        stats["symlink_loops"] += 1
                         continue
-                    in_call = True
-                    call_name = name
-                    call_line = i
-                    buffer = [line.rstrip("\n")]
-                    paren_balance = count_parens(code_line[pos:])
-                    if ";" in code_line and paren_balance <= 0:
-                        results.append((path, call_line, call_name, " ".join(buffer).strip()))
-                        in_call = False
-                        call_name = None
-                        call_line = None
-                        buffer = []
-                        paren_balance = 0
-                else:
-                    buffer.append(line.rstrip("\n"))
-                    paren_balance += count_parens(code_line)
-                    if ";" in code_line and paren_balance <= 0:
-                        results.append((path, call_line, call_name, " ".join(buffer).strip()))
-                        in_call = False
-                        call_name = None
-                        call_line = None
-                        buffer = []
-                        paren_balance = 0
-                    elif len(buffer) > 50:
-                        in_call = False
-                        call_name = None
-                        call_line = None
-                        buffer = []
-                        paren_balance = 0
+                    seen_dirs.add(key)
+                subdirs.append((os.path.join(dirpath, entry.name), rel))
+                continue
+            fp = os.path.join(dirpath, entry.name)
+            if not is_source_file(fp):
+                continue
+            if _is_ignored(rule_sets, rel, False):
+                stats["files_ignored"] += 1
+                continue
+            if max_size > 0:
+                try:
+                    if entry.stat().st_size > max_size:
+                        stats["files_oversize"] += 1
+                        continue
+                except OSError:
+                    pass
+            yield fp
+        for path, rel in reversed(subdirs):
+            stack.append((path, rel, rule_sets))
+
+# Files at least this big are probed through mmap instead of read().
+MMAP_THRESHOLD = 1 << 20
+
+# Chunk size for lowering mapped files before the prefilter search.
+PROBE_CHUNK = 4 << 20
+
+def _probe_bytes(data, byte_filter, digest):
+    if byte_filter is None:
+        hit = True
+    elif isinstance(data, bytes):
+        hit = byte_filter.search(data.lower()) is not None
+    else:
+        # Chunks overlap by more than any macro name is long, so a name cut
+        # off at a chunk end is whole in the next one.
+        hit = False
+        overlap = 256
+        for off in range(0, len(data), PROBE_CHUNK):
+            if byte_filter.search(data[max(0, off - overlap):off + PROBE_CHUNK].lower()):
+                hit = True
+                break
+    return hit, (hashlib.sha1(data).hexdigest() if digest else None)
+
+def probe_file(path, byte_filter, digest=False):
+    """
+    One raw read of path: returns (may_contain_starter, sha1 or None,
+    decoded lines or None). The lines are only decoded for a hit, so the
+    scan does not read the file again. Large files are mapped and only
+    copied out if they hit.
+    """
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size >= MMAP_THRESHOLD:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                hit, sha = _probe_bytes(data, byte_filter, digest)
+                return hit, sha, decode_lines(data[:]) if hit else None
+        data = f.read()
+        hit, sha = _probe_bytes(data, byte_filter, digest)
+        return hit, sha, decode_lines(data) if hit else None
+
+def _profiled_scan(path, starters, info, start, lines=None):
+    timings = {"io": time.perf_counter() - start, "lex": 0.0, "match": 0.0}
+    rows = []
+    try:
+        if lines is None:
+            t = time.perf_counter()
+            with open(path, "r", errors="ignore") as f:
+                lines = f.readlines()
+            timings["io"] += time.perf_counter() - t
+        for row in scan_lines(path, lines, starters, timings):
+            rows.append(row)
     except Exception:
         pass
-    return results
+    info["profile"] = {"path": path, "wall": time.perf_counter() - start, "io": timings["io"],
+                       "lex": timings["lex"], "match": timings["match"], "bytes": info["size"],
+                       "lines": len(lines or []), "matches": len(rows), "skipped": False}
+    return rows, info
+
+def scan_path(path, patterns, starters, digest=False, prefilter=True, discover=False, profile=False):
+    """
+    scan_file() for the tree walkers. Returns (rows, info): info has the
+    file size, whether the byte prefilter skipped it, with digest=True the
+    mtime and hash the scan cache stores, with discover=True the
+    discover_lines() data gathered from the same read, and with
+    profile=True a per-file timing record.
+    """
+    info = {"size": 0, "skipped": False}
+    start = time.perf_counter() if profile else 0.0
+    if discover:
+        rows = []
+        try:
+            with open(path, "r", errors="ignore") as f:
+                lines = f.readlines()
+            info["discovery"] = discover_lines(path, lines)
+            for row in scan_lines(path, lines, starters):
+                rows.append(row)
+        except Exception:
+            pass
+        return rows, info
+    byte_filter = starters.byte_filter() if prefilter and isinstance(starters, StarterSet) else None
+    lines = None
+    if byte_filter is not None or digest:
+        try:
+            st = os.stat(path)
+            hit, sha, lines = probe_file(path, byte_filter, digest)
+        except (OSError, ValueError):
+            return scan_file(path, patterns, starters), info
+        info["size"] = st.st_size
+        if digest:
+            info["mtime"] = st.st_mtime_ns
+            info["hash"] = sha
+        if not hit:
+            info["skipped"] = True
+            if profile:
+                info["profile"] = {"path": path, "wall": time.perf_counter() - start,
+                                   "io": time.perf_counter() - start, "lex": 0.0, "match": 0.0,
+                                   "bytes": st.st_size, "lines": 0, "matches": 0, "skipped": True}
+            return [], info
+    if profile:
+        if not info["size"]:
+            try:
+                info["size"] = os.stat(path).st_size
+            except OSError:
+                pass
+        return _profiled_scan(path, starters, info, start, lines)
+    if lines is not None:
+        return scan_decoded(path, lines, starters), info
+    return scan_file(path, patterns, starters), info
+
+_worker_patterns = None
+_worker_starters = None
+_worker_options = None
+
+def _init_worker(patterns, starters, options):
+    global _worker_patterns, _worker_starters, _worker_options
+    _worker_patterns = patterns
+    _worker_starters = starters
+    _worker_options = options
+
+def _scan_worker(path):
+    return scan_path(path, _worker_patterns, _worker_starters, **_worker_options)
+
+def scan_files(paths, patterns, starters, jobs=1, **options):
+    """
+    Yield scan_path(path, patterns, starters, **options) for each path, in
+    the order of paths. With jobs > 1 the files are sharded over a process
+    pool; results are still yielded in input order so the output matches a
+    serial run.
+    """
+    if jobs <= 1:
+        for fp in paths:
+            yield scan_path(fp, patterns, starters, **options)
+        return
+    paths = list(paths)
+    chunksize = max(1, min(64, len(paths) // (jobs * 8)))
+    with ProcessPoolExecutor(max_workers=jobs, initializer=_init_worker,
+                             initargs=(patterns, starters, options)) as pool:
+        for res in pool.map(_scan_worker, paths, chunksize=chunksize):
+            yield res
+
+# Bump when scan_file output can change for the same input and patterns.
+SCAN_CACHE_VERSION = 1
+
+def patterns_fingerprint(starters):
+    h = hashlib.sha1(str(SCAN_CACHE_VERSION).encode())
+    for name, rx in starters.items():
+        h.update(b"\0" + name.encode("utf-8") + b"\0" + rx.pattern.encode("utf-8"))
+    return h.hexdigest()
+
+def file_digest(path):
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+def load_scan_cache(cache_path, fingerprint):
+    """Return {path: entry} from a scan manifest, or {} if missing or stale."""
+    if not cache_path or not os.path.exists(cache_path):
+        return {}
+    try:
+        with open(cache_path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+    except Exception as e:
+        log(f"Ignoring unreadable scan cache {cache_path}: {e}")
+        return {}
+    if data.get("fingerprint") != fingerprint:
+        log(f"Scan cache {cache_path} was built with other patterns, rescanning.")
+        return {}
+    return data.get("files", {})
+
+def save_scan_cache(cache_path, fingerprint, files):
+    tmp = cache_path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump({"fingerprint": fingerprint, "files": files}, f)
+    os.replace(tmp, cache_path)
+
+def _cached_rows(path, entry):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    if entry["size"] != st.st_size:
+        return None
+    if entry["mtime"] != st.st_mtime_ns:
+        # Touched but maybe not modified (checkout, rebase): compare content.
+        try:
+            if file_digest(path) != entry["hash"]:
+                return None
+        except OSError:
+            return None
+        entry["mtime"] = st.st_mtime_ns
+    return [(path, r[0], r[1], r[2]) for r in entry["rows"]]
+
+def new_scan_stats():
+    return {"files": 0, "files_cached": 0, "files_skipped": 0, "bytes_skipped": 0,
+            "dirs_pruned": 0, "files_ignored": 0, "files_oversize": 0, "symlink_loops": 0}
 
-def walk_root(root, patterns, starters):
-    all_results = []
-    for dirpath, dirnames, filenames in os.walk(root):
-        for fn in filenames:
-            fp = os.path.join(dirpath, fn)
-            if is_source_file(fp):
-                res = scan_file(fp, patterns, starters)
-                if res:
-                    all_results.extend(res)
-    return all_results
+def _count_file(stats, info):
+    stats["files"] += 1
+    if "profile" in info:
+        stats.setdefault("profile", []).append(info["profile"])
+    if info["skipped"]:
+        stats["files_skipped"] += 1
+        stats["bytes_skipped"] += info["size"]
+
+def iter_scan(root, patterns, starters, jobs=1, cache_path=None, stats=None, profile=False, **walk_opts):
+    """
+    Yield (path, line, style, text) rows for every source file under root,
+    file by file as each scan finishes, in walk order. With cache_path,
+    files whose size, mtime (or content hash) match the manifest reuse their
+    cached rows and only the rest are rescanned; the manifest is rewritten
+    once the generator is exhausted. Per-run counters are added to stats
+    (see new_scan_stats) if given, and with profile=True one timing record
+    per scanned file goes to stats["profile"]. walk_opts go to
+    iter_source_files.
+    """
+    if stats is None:
+        stats = new_scan_stats()
+    if not cache_path:
+        for res, info in scan_files(iter_source_files(root, stats, **walk_opts), patterns, starters, jobs,
+                                    profile=profile):
+            _count_file(stats, info)
+            yield from res
+        return
+
+    fingerprint = patterns_fingerprint(starters)
+    old_files = load_scan_cache(cache_path, fingerprint)
+    paths = list(iter_source_files(root, stats, **walk_opts))
+    cached = {}
+    misses = []
+    for fp in paths:
+        entry = old_files.get(fp)
+        rows = _cached_rows(fp, entry) if entry else None
+        if rows is None:
+            misses.append(fp)
+        else:
+            cached[fp] = rows
+    log(f"Scan cache: {len(cached)} files reused, {len(misses)} to scan.")
+    # Misses come back from the pool in the same relative order as paths.
+    scanned = scan_files(misses, patterns, starters, jobs, digest=True, profile=profile)
+    new_files = {}
+    for fp in paths:
+        if fp in cached:
+            new_files[fp] = old_files[fp]
+            stats["files"] += 1
+            stats["files_cached"] += 1
+            yield from cached.pop(fp)
+            continue
+        res, info = next(scanned)
+        _count_file(stats, info)
+        if info.get("hash"):
+            new_files[fp] = {"size": info["size"], "mtime": info["mtime"], "hash": info["hash"],
+                             "rows": [[r[1], r[2], r[3]] for r in res]}
+        yield from res
+    try:
+        save_scan_cache(cache_path, fingerprint, new_files)
+    except Exception as e:
+        log(f"Failed to write scan cache {cache_path}: {e}")
+
+def walk_root(root, patterns, starters, jobs=1, cache_path=None, stats=None, **walk_opts):
+    return list(iter_scan(root, patterns, starters, jobs, cache_path, stats, **walk_opts))
+
+def _git(root, *args):
+    out = subprocess.run(["git", "-C", root] + list(args), check=True,
+                         stdout=subprocess.PIPE, stderr=subprocess.PIPE).stdout
+    return out.decode("utf-8", errors="surrogateescape")
+
+def git_changed_files(root, since=None, diff=None):
+    """
+    Source files under root that changed in git, as (changed, deleted) sets
+    of paths joined onto root the same way the walker builds them.
+    since=REV compares REV with the working tree (untracked files count as
+    added); diff="A..B" compares two revisions.
+    """
+    if diff:
+        if ".." not in diff:
+            raise ValueError(f"--diff expects REV_A..REV_B, got {diff!r}")
+        rev_a, rev_b = diff.split("..", 1)
+        revs = [rev_a or "HEAD", rev_b or "HEAD"]
+    else:
+        revs = [since]
+    out = _git(root, "diff", "--name-status", "--no-renames", "--relative", "-z", *revs)
+    fields = out.split("\0")
+    changed = set()
+    deleted = set()
+    for status, rel in zip(fields[0::2], fields[1::2]):
+        fp = os.path.join(root, rel)
+        if not is_source_file(fp):
+            continue
+        if status.startswith("D"):
+            deleted.add(fp)
+        else:
+            changed.add(fp)
+    if not diff:
+        for rel in _git(root, "ls-files", "--others", "--exclude-standard", "-z").split("\0"):
+            if rel and is_source_file(rel):
+                changed.add(os.path.join(root, rel))
+    # Files edited and then removed without git rm show up as modified.
+    gone = {fp for fp in changed if not os.path.exists(fp)}
+    return changed - gone, deleted | gone
+
+def filter_changed(root, changed, deleted, stats=None, ignore_file=None, use_gitignore=True,
+                   max_size=0, follow_links=False):
+    """
+    Apply the walker's ignore rules and size cap to git_changed_files
+    output. Changed files a full scan would skip are moved to the deleted
+    set, so their rows leave the patched CSV as they would a full scan.
+    follow_links is accepted for the walk_opts signature only.
+    """
+    if stats is None:
+        stats = new_scan_stats()
+    base_rules = _base_rules(root, ignore_file)
+    dir_rules = {}
+
+    def rules_in(rel_dir):
+        # Rule sets in force for the entries of rel_dir, as iter_source_files stacks them
+        if rel_dir not in dir_rules:
+            rules = rules_in(rel_dir.rpartition("/")[0]) if rel_dir else base_rules
+            gitignore = os.path.join(root, rel_dir, ".gitignore")
+            if use_gitignore and os.path.isfile(gitignore):
+                try:
+                    rules = rules + [IgnoreRules.from_file(gitignore, rel_dir)]
+                except OSError:
+                    pass
+            dir_rules[rel_dir] = rules
+        return dir_rules[rel_dir]
+
+    def ignored(fp):
+        parts = os.path.relpath(fp, root).replace(os.sep, "/").split("/")
+        for i in range(1, len(parts)):
+            if _is_ignored(rules_in("/".join(parts[:i - 1])), "/".join(parts[:i]), True):
+                return True
+        return _is_ignored(rules_in("/".join(parts[:-1])), "/".join(parts), False)
+
+    kept = set()
+    dropped = set()
+    for fp in changed:
+        if ignored(fp):
+            stats["files_ignored"] += 1
+            dropped.add(fp)
+            continue
+        if max_size > 0:
+            try:
+                if os.path.getsize(fp) > max_size:
+                    stats["files_oversize"] += 1
+                    dropped.add(fp)
+                    continue
+            except OSError:
+                pass
+        kept.add(fp)
+    # Deleted files keep their entry: their old rows go either way.
+    return kept, set(deleted) | dropped
+
+def iter_patched(base_csv, changed, deleted, patterns, starters, jobs=1, stats=None):
+    """
+    Yield the rows of a previous step-1 CSV with every row of changed or
+    deleted files dropped and the changed files rescanned. A changed file's
+    new rows take the place of its old block; files that had no rows before
+    are appended at the end.
+    """
+    if stats is None:
+        stats = new_scan_stats()
+    changed_list = sorted(changed)
+    fresh = {}
+    for fp, (res, info) in zip(changed_list, scan_files(changed_list, patterns, starters, jobs)):
+        _count_file(stats, info)
+        fresh[fp] = res
+    csv.field_size_limit(sys.maxsize)
+    with open(base_csv, "r", newline="") as f:
+        reader = csv.reader(f)
+        next(reader, None)
+        for r in reader:
+            fp = r[0]
+            if fp in fresh:
+                yield from fresh.pop(fp)
+                continue
+            if fp in changed or fp in deleted:
+                continue
+            yield tuple(r)
+    for fp in changed_list:
+        yield from fresh.pop(fp, [])
+
+def discover_scan(root, patterns, starters, jobs=1, stats=None, **walk_opts):
+    """
+    Extract rows and discover log macros in one read of every file.
+    Wrapper macros found through #define chains are used for this run too:
+    only the files that call one are scanned again with them added.
+    Returns (rows, candidates, wrappers) where candidates maps a name to
+    [count, first "path:line"].
+    """
+    if stats is None:
+        stats = new_scan_stats()
+    paths = list(iter_source_files(root, stats, **walk_opts))
+    per_file = []
+    calls = []
+    candidates = {}
+    defines = {}
+    for res, info in scan_files(paths, patterns, starters, jobs, discover=True):
+        _count_file(stats, info)
+        per_file.append(res)
+        found = info.get("discovery") or {"candidates": {}, "calls": [], "defines": {}}
+        calls.append(found["calls"])
+        for name, (count, sample) in found["candidates"].items():
+            entry = candidates.get(name)
+            if entry:
+                entry[0] += count
+            else:
+                candidates[name] = [count, sample]
+        for name, callees in found["defines"].items():
+            defines.setdefault(name, callees)
+    wrappers = resolve_wrappers(defines, starters)
+    if wrappers:
+        log(f"Wrapper macros found: {wrappers}")
+        more_patterns = dict(patterns)
+        more_starters = StarterSet()
+        for name, rx in starters.items():
+            more_starters[name] = rx
+        for name in wrappers:
+            add_pattern(more_patterns, more_starters, name)
+        wanted = {w.lower() for w in wrappers}
+        redo = [i for i, names in enumerate(calls) if any(n.lower() in wanted for n in names)]
+        log(f"Rescanning {len(redo)} files that call them.")
+        redo_paths = [paths[i] for i in redo]
+        for i, (res, info) in zip(redo, scan_files(redo_paths, more_patterns, more_starters, jobs, prefilter=False)):
+            per_file[i] = res
+    rows = [r for res in per_file for r in res]
+    return rows, candidates, wrappers
+
+def write_discovery(out_path, candidates, wrappers, starters):
+    """Ranked candidate list: name, count, known/wrapper/new, first location."""
+    known = {n.lower() for n in starters}
+    names = set(candidates) | set(wrappers)
+    ranked = sorted(names, key=lambda n: (-candidates.get(n, [0])[0], n))
+    with open(out_path, "w", encoding="utf-8") as w:
+        for name in ranked:
+            count, sample = candidates.get(name, [0, ""])
+            if name in wrappers:
+                kind = f"wrapper->{wrappers[name]}"
+            elif name.lower() in known:
+                kind = "known"
+            else:
+                kind = "new"
+            w.write(f"{name}\t{count}\t{kind}\t{sample}\n")
+    return len(ranked)
+
+def profile_report(records, elapsed, top=20):
+    """Summarize per-file profile records from a scan that took elapsed seconds."""
+    total = {k: sum(r[k] for r in records) for k in ("wall", "io", "lex", "match", "bytes", "lines", "matches")}
+    dirs = {}
+    for r in records:
+        d = dirs.setdefault(os.path.dirname(r["path"]), {"wall": 0.0, "files": 0, "bytes": 0, "lines": 0})
+        d["wall"] += r["wall"]
+        d["files"] += 1
+        d["bytes"] += r["bytes"]
+        d["lines"] += r["lines"]
+    slowest_dirs = sorted(dirs.items(), key=lambda kv: -kv[1]["wall"])[:top]
+    elapsed = max(elapsed, 1e-9)
+    return {
+        "elapsed": elapsed,
+        "files": len(records),
+        "files_skipped": sum(1 for r in records if r["skipped"]),
+        "bytes": total["bytes"],
+        "lines": total["lines"],
+        "matches": total["matches"],
+        "mb_per_s": total["bytes"] / (1 << 20) / elapsed,
+        "lines_per_s": total["lines"] / elapsed,
+        # Summed over files, so with --jobs N this can exceed elapsed.
+        "time_split": {"io": total["io"], "lex": total["lex"], "match": total["match"],
+                       "other": max(0.0, total["wall"] - total["io"] - total["lex"] - total["match"])},
+        "slowest_files": sorted(records, key=lambda r: -r["wall"])[:top],
+        "slowest_dirs": [dict(dir=k, **v) for k, v in slowest_dirs],
+        "per_file": records,
+    }
+
+def format_profile(report):
+    split = report["time_split"]
+    busy = max(sum(split.values()), 1e-9)
+    out = [f"Profile: {report['files']} files, {report['bytes'] / (1 << 20):.1f} MB, {report['lines']} lines "
+           f"in {report['elapsed']:.2f}s -> {report['mb_per_s']:.2f} MB/s, {report['lines_per_s']:.0f} lines/s",
+           "Time split: " + ", ".join(f"{k} {v:.2f}s ({100 * v / busy:.0f}%)" for k, v in split.items()),
+           "Slowest files:"]
+    for r in report["slowest_files"]:
+        out.append(f"  {r['wall'] * 1000:8.1f} ms  {r['bytes'] / 1024:8.1f} KB  {r['lines']:7d} lines  {r['path']}")
+    out.append("Slowest dirs:")
+    for d in report["slowest_dirs"]:
+        out.append(f"  {d['wall'] * 1000:8.1f} ms  {d['files']:5d} files  {d['dir']}")
+    return "\n".join(out)
+
+def format_scan_stats(stats):
+    return (f"Files: {stats['files']} (cached {stats['files_cached']}, "
+            f"skipped by prefilter {stats['files_skipped']}, "
+            f"{stats['bytes_skipped'] / (1 << 20):.1f} MB not decoded; "
+            f"pruned {stats['dirs_pruned']} dirs, ignored {stats['files_ignored']} files, "
+            f"{stats['files_oversize']} over size cap, {stats['symlink_loops']} symlink loops)")
+
+# write_output flushes after this many rows so readers can follow the file.
+FLUSH_EVERY = 1000
 
 def write_output(out_path, rows, fmt):
+    """
+    Write rows (any iterable, e.g. iter_scan) to out_path as it is consumed.
+    Returns the number of rows written.
+    """
+    count = 0
     if not out_path:
-        return
+        return count
     try:
         if fmt == "csv":
             with open(out_path, "w", newline="") as w:
@@ -203,12 +1089,19 @@ def write_output(out_path, rows, fmt):
                 writer.writerow(["file", "line", "style", "text"])
                 for r in rows:
                     writer.writerow([r[0], r[1], r[2], r[3]])
+                    count += 1
+                    if count % FLUSH_EVERY == 0:
+                        w.flush()
         else:
             with open(out_path, "w") as w:
                 for r in rows:
                     w.write(f"{r[0]}:{r[1]}\t{r[2]}\t{r[3]}\n")
+                    count += 1
+                    if count % FLUSH_EVERY == 0:
+                        w.flush()
     except Exception as e:
         sys.stderr.write(str(e) + "\n")
+    return count
 
 def summarize(rows):
     stats = {}
@@ -222,18 +1115,85 @@ def main():
     ap.add_argument("--out", default="")
     ap.add_argument("--limit", type=int, default=0)
     ap.add_argument("--format", choices=["csv", "tsv"], default="csv")
+    ap.add_argument("--jobs", type=int, default=os.cpu_count() or 1,
+                    help="number of scanner processes (1 = serial)")
+    ap.add_argument("--cache", default="",
+                    help="scan manifest; unchanged files reuse their rows from it")
+    ap.add_argument("--check-lexer", action="store_true",
+                    help="compare analyze_line with analyze_line_reference on every file under --root and exit")
+    ap.add_argument("--since", default="",
+                    help="git rev: only rescan files changed between it and the working tree")
+    ap.add_argument("--diff", default="",
+                    help="REV_A..REV_B: only rescan files changed between two git revs")
+    ap.add_argument("--base-csv", default="",
+                    help="previous step-1 CSV to patch in --since/--diff mode")
+    ap.add_argument("--ignore-file", default="",
+                    help=f"extra ignore rules (default: ROOT/{PROJECT_IGNORE_FILE} if present)")
+    ap.add_argument("--no-gitignore", action="store_true", help="do not apply .gitignore files")
+    ap.add_argument("--max-file-size", type=int, default=0,
+                    help="skip source files larger than this many bytes (0 = no cap)")
+    ap.add_argument("--follow-links", action="store_true", help="descend into symlinked directories")
+    ap.add_argument("--profile", default="",
+                    help="write a per-file timing report (JSON) here and print the slowest files/dirs")
+    ap.add_argument("--profile-top", type=int, default=20)
+    ap.add_argument("--discover", default="",
+                    help="also write ranked candidate log macros to this file and "
+                         "pick up #define wrappers of known macros (replaces grep + extract_log_print_patterns.py)")
     args = ap.parse_args()
+    walk_opts = {"ignore_file": args.ignore_file or None, "use_gitignore": not args.no_gitignore,
+                 "max_size": args.max_file_size, "follow_links": args.follow_links}
+    if (args.since or args.diff) and not args.base_csv:
+        ap.error("--since/--diff need --base-csv to patch")
+    if args.check_lexer:
+        import check_lexer
+        mismatches = check_lexer.check_cases() + check_lexer.check_lexer(iter_source_files(args.root, **walk_opts))
+        check_lexer.report(mismatches)
+        sys.stdout.write(f"Lexer mismatches: {len(mismatches)}\n")
+        sys.exit(1 if mismatches else 0)
     patterns, starters = build_patterns()
-    rows = walk_root(args.root, patterns, starters)
-    stats = summarize(rows)
-    sys.stdout.write("Total matches: " + str(len(rows)) + "\n")
+    scan_stats = new_scan_stats()
+    stats = {}
+    sample = []
+
+    def tally(rows):
+        for r in rows:
+            stats[r[2]] = stats.get(r[2], 0) + 1
+            if len(sample) < args.limit:
+                sample.append(r)
+            yield r
+
+    if args.discover:
+        found, candidates, wrappers = discover_scan(args.root, patterns, starters, args.jobs, scan_stats, **walk_opts)
+        n = write_discovery(args.discover, candidates, wrappers, starters)
+        sys.stdout.write(f"Discovery: {n} candidate macros, {len(wrappers)} wrappers -> {args.discover}\n")
+        rows = tally(found)
+    elif args.since or args.diff:
+        changed, deleted = git_changed_files(args.root, args.since, args.diff)
+        changed, deleted = filter_changed(args.root, changed, deleted, scan_stats, **walk_opts)
+        sys.stdout.write(f"Git: {len(changed)} changed, {len(deleted)} deleted source files\n")
+        rows = tally(iter_patched(args.base_csv, changed, deleted, patterns, starters, args.jobs, scan_stats))
+    else:
+        rows = tally(iter_scan(args.root, patterns, starters, args.jobs, args.cache, scan_stats,
+                               profile=bool(args.profile), **walk_opts))
+    started = time.perf_counter()
+    if args.out:
+        write_output(args.out, rows, args.format)
+    else:
+        for _ in rows:
+            pass
+    if args.profile:
+        report = profile_report(scan_stats.get("profile", []), time.perf_counter() - started, args.profile_top)
+        with open(args.profile, "w", encoding="utf-8") as w:
+            json.dump(report, w, indent=1)
+        sys.stdout.write(format_profile(report) + "\n")
+    sys.stdout.write(format_scan_stats(scan_stats) + "\n")
+    sys.stdout.write("Total matches: " + str(sum(stats.values())) + "\n")
     for k in sorted(stats.keys()):
         sys.stdout.write(f"{k}: {stats[k]}\n")
-    if args.limit > 0:
+    if sample:
         sys.stdout.write("Sample:\n")
-        for r in rows[:args.limit]:
+        for r in sample:
             sys.stdout.write(f"{r[0]}:{r[1]}\t{r[2]}\t{r[3]}\n")
-    write_output(args.out, rows, args.format)
 
 if __name__ == "__main__":
     main()
@@ -19,6 +19,12 @@ def extract_content(text):
         return match.group(1)
     return ""
 
+def iter_extract(rows):
+    """Yield rows (dicts with a 'text' key) with text replaced by its first quoted string."""
+    for row in rows:
+        row['text'] = extract_content(row['text'])
+        yield row
+
 def process_csv(input_path, output_path):
     if not os.path.exists(input_path):
         print(f"Error: Input file not found at {input_path}")
@@ -44,10 +50,7 @@ def process_csv(input_path, output_path):
             writer.writeheader()
 
             print("Processing rows...")
-            for row in reader:
-                original_text = row['text']
-                extracted_text = extract_content(original_text)
-                row['text'] = extracted_text
+            for row in iter_extract(reader):
                 writer.writerow(row)
                 rows_processed += 1
         
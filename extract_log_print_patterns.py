@@ -1,51 +1,130 @@
 import re
 import os
+import mmap
+import argparse
+from concurrent.futures import ProcessPoolExecutor
 
 INPUT_FILE = "/home/bj17300-049u/work/mediahal_wraper/log_print.txt"
 OUTPUT_FILE = "/home/bj17300-049u/work/mediahal_wraper/extracted_log_print_patterns.txt"
+# Same names ranked by occurrence count, with sample grep locations
+RANKED_FILE = os.path.splitext(OUTPUT_FILE)[0] + "_ranked.txt"
 
-def extract_patterns():
+# Regex to match a function name followed by '(', where the arguments contain a double quote.
+# This filters for log-like calls e.g. LOG("msg") or func(arg, "str")
+# It matches the identifier, followed by (, and checks for a quote before the closing )
+# Works on raw bytes of the whole chunk, so a match must not run past the end of its line.
+regex = re.compile(rb'([a-zA-Z_][a-zA-Z0-9_]*)[ \t\r\f\v]*\([^)\n]*"')
+# grep -n prefix of a log_print.txt line: path:line:
+location_regex = re.compile(rb'([^\n]*?:\d+):')
+
+# Work is split into chunks of about this many bytes, cut at line ends
+CHUNK_SIZE = 16 << 20
+
+def chunk_ranges(path, chunk_size=CHUNK_SIZE):
+    size = os.path.getsize(path)
+    if size == 0:
+        return []
+    ranges = []
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        start = 0
+        while start < size:
+            end = mm.find(b"\n", min(start + chunk_size, size))
+            end = size if end < 0 else end + 1
+            ranges.append((start, end))
+            start = end
+    return ranges
+
+def count_chunk(args):
+    """
+    Count names in one [start, end) range of the grep output.
+    Returns {name: [count, [sample locations]]}.
+    """
+    path, start, end, samples = args
+    found = {}
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        for m in regex.finditer(mm, start, end):
+            name = m.group(1).decode("ascii")
+            entry = found.get(name)
+            if entry is None:
+                entry = found[name] = [0, []]
+            entry[0] += 1
+            if len(entry[1]) < samples:
+                nl = mm.rfind(b"\n", start, m.start())
+                line_start = start if nl < 0 else nl + 1
+                loc = location_regex.match(mm, line_start, m.start())
+                if loc:
+                    entry[1].append(loc.group(1).decode("utf-8", errors="ignore"))
+    return found
+
+def count_patterns(path, jobs=1, samples=3):
+    """{name: [count, [sample locations]]} over the whole grep output."""
+    tasks = [(path, start, end, samples) for start, end in chunk_ranges(path)]
+    if jobs > 1 and len(tasks) > 1:
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            parts = list(pool.map(count_chunk, tasks))
+    else:
+        parts = [count_chunk(t) for t in tasks]
+    counts = {}
+    # Chunks are merged in file order so the samples are the first occurrences.
+    for part in parts:
+        for name, (count, locs) in part.items():
+            entry = counts.get(name)
+            if entry is None:
+                counts[name] = [count, locs]
+            else:
+                entry[0] += count
+                entry[1].extend(locs[:samples - len(entry[1])])
+    return counts
+
+def extract_patterns(jobs=1):
     if not os.path.exists(INPUT_FILE):
         print(f"Error: {INPUT_FILE} does not exist.")
         return set()
 
-    patterns = set()
-    # Regex to match a function name followed by '(', where the arguments contain a double quote.
-    # This filters for log-like calls e.g. LOG("msg") or func(arg, "str")
-    # It matches the identifier, followed by (, and checks for a quote before the closing )
-    regex = re.compile(r'([a-zA-Z_][a-zA-Z0-9_]*)\s*\([^)]*"')
-
     print(f"Reading from {INPUT_FILE}...")
-    with open(INPUT_FILE, 'r', encoding='utf-8', errors='ignore') as f:
-        for line in f:
-            # Find all matches in the line
-            matches = regex.findall(line)
-            for match in matches:
-                # 'match' is just the captured group 1 (the function/macro name)
-                # Filter out common control keywords if necessary, but user asked for "string immediately before ("
-                # Let's keep it raw as requested, but maybe filter out empty strings if any (regex \w+ won't match empty).
-                patterns.add(match)
-
-    return patterns
+    return set(count_patterns(INPUT_FILE, jobs))
 
 def main():
-    patterns = extract_patterns()
-    
-    if not patterns:
+    global INPUT_FILE, OUTPUT_FILE, RANKED_FILE
+    ap = argparse.ArgumentParser(description="Collect candidate log macro names from grep -n output.")
+    ap.add_argument("--input", default=INPUT_FILE)
+    ap.add_argument("--output", default=OUTPUT_FILE)
+    ap.add_argument("--ranked", default="", help="ranked list with counts (default: <output>_ranked.txt)")
+    ap.add_argument("--jobs", type=int, default=os.cpu_count() or 1)
+    ap.add_argument("--samples", type=int, default=3, help="sample locations kept per name")
+    args = ap.parse_args()
+    INPUT_FILE = args.input
+    OUTPUT_FILE = args.output
+    RANKED_FILE = args.ranked or os.path.splitext(OUTPUT_FILE)[0] + "_ranked.txt"
+
+    if not os.path.exists(INPUT_FILE):
+        print(f"Error: {INPUT_FILE} does not exist.")
+        return
+    print(f"Reading from {INPUT_FILE}...")
+    counts = count_patterns(INPUT_FILE, args.jobs, args.samples)
+
+    if not counts:
         print("No patterns found.")
         return
 
-    print(f"Found {len(patterns)} unique patterns.")
-    
+    print(f"Found {len(counts)} unique patterns.")
+
     # Sort for better readability
-    sorted_patterns = sorted(list(patterns))
-    
+    sorted_patterns = sorted(counts)
+
     with open(OUTPUT_FILE, 'w', encoding='utf-8') as f:
         for p in sorted_patterns:
             f.write(p + "\n")
             print(p)
 
+    # Most frequent first: real log macros float to the top, one-off calls sink
+    ranked = sorted(counts.items(), key=lambda kv: (-kv[1][0], kv[0]))
+    with open(RANKED_FILE, 'w', encoding='utf-8') as f:
+        for name, (count, locs) in ranked:
+            f.write(f"{count}\t{name}\t{' '.join(locs)}\n")
+
     print(f"Results written to {OUTPUT_FILE}")
+    print(f"Ranked list written to {RANKED_FILE}")
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,61 @@
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+
+# One keep-alive session shared by the LLM and tokenizer clients, so every
+# batch or tokenized line reuses a pooled connection instead of a new TCP
+# (and possibly TLS) handshake.
+POOL_CONNECTIONS = 4   # hosts with a cached pool
+POOL_MAXSIZE = 16      # connections kept per host; keep >= concurrent callers (PARALLEL_BATCHES)
+CONNECT_TIMEOUT = 5
+READ_TIMEOUT = 60
+
+_session = None
+_lock = threading.Lock()
+
+def _new_session():
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+def get_session():
+    global _session
+    if _session is None:
+        with _lock:
+            if _session is None:
+                _session = _new_session()
+    return _session
+
+def configure(pool_connections=None, pool_maxsize=None, connect_timeout=None, read_timeout=None):
+    """Change pool size / default timeouts; the next request opens a new pool."""
+    global POOL_CONNECTIONS, POOL_MAXSIZE, CONNECT_TIMEOUT, READ_TIMEOUT
+    if pool_connections is not None:
+        POOL_CONNECTIONS = pool_connections
+    if pool_maxsize is not None:
+        POOL_MAXSIZE = pool_maxsize
+    if connect_timeout is not None:
+        CONNECT_TIMEOUT = connect_timeout
+    if read_timeout is not None:
+        READ_TIMEOUT = read_timeout
+    close()
+
+def timeout(read=None):
+    """(connect, read) timeout tuple for requests."""
+    return (CONNECT_TIMEOUT, READ_TIMEOUT if read is None else read)
+
+def post(url, read_timeout=None, **kwargs):
+    kwargs.setdefault("timeout", timeout(read_timeout))
+    return get_session().post(url, **kwargs)
+
+def is_unreachable(exc):
+    """True for errors meaning the host is down, as opposed to a bad answer."""
+    return isinstance(exc, (requests.ConnectionError, requests.Timeout))
+
+def close():
+    global _session
+    with _lock:
+        if _session is not None:
+            _session.close()
+            _session = None
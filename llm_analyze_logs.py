@@ -1,4 +1,3 @@
-import requests
 import json
 import sys
 import os
@@ -7,7 +6,17 @@ import argparse
 import contextlib
 import io
 import re
-from logger import log
+import hashlib
+import threading
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import requests
+import logger
+from logger import log, debug, log_limited
+import http_session
+import verdict_cache
+import log_rules
 
 # Ensure we can import from the current directory
 current_dir = os.path.dirname(os.path.abspath(__file__))
@@ -25,6 +34,47 @@ OUTPUT_FILE = os.path.join(current_dir, "01201605_mediahal_logset_suspicious_ana
 OLLAMA_URL = "http://10.58.11.60:11434/api/generate"
 MODEL = "qwen3:8b-q8_0"
 BATCH_TOKEN_LIMIT = 512  # Conservative limit to allow space for prompt and response
+# Batches sent to Ollama concurrently; set OLLAMA_NUM_PARALLEL on the server to at least this
+PARALLEL_BATCHES = 4
+LLM_TIMEOUT = 600  # read timeout per batch
+# Size batches with the offline token estimator (token_estimator.py) instead of
+# the tokenizer API; the estimator's upper bound keeps them within BATCH_TOKEN_LIMIT.
+OFFLINE_TOKENS = False
+# Reuse verdicts of earlier runs (verdict_cache.py); only uncached lines are sent
+VERDICT_CACHE = True
+# Append-only record of finished batches (default: OUTPUT_FILE + ".journal");
+# --resume skips what it lists and rebuilds the report from it.
+JOURNAL_FILE = ""
+RESUME = False
+LLM_OPTIONS = {
+    "temperature": 0.3,
+    "top_p": 0.3,
+    "num_ctx": 8192
+}
+# Stream Ollama's NDJSON output: SUSPICIOUS_ID lines go to LIVE_FILE (default
+# OUTPUT_FILE + ".live") as soon as they are complete, and a batch answered
+# with NONE is cut off right there.
+LLM_STREAM = True
+LIVE_FILE = ""
+# Per-batch caps: generated tokens (Ollama num_predict, 0 = no cap) and
+# wall-clock seconds (0 = no cap). A capped batch keeps the lines it
+# finished; the logs it did not reach go to OUTPUT_FAIL_FILE and are retried
+# by --resume. Without streaming there are no finished lines to keep, so a
+# batch over LLM_MAX_SECONDS counts as unanswered.
+LLM_MAX_TOKENS = 0
+LLM_MAX_SECONDS = 0
+# Exit status of an interrupted run (as for SIGINT)
+INTERRUPTED_EXIT = 130
+# At most one "Processing batch" line per this many seconds
+BATCH_LOG_INTERVAL = 5.0
+# Appended to a capped answer, whose unlisted logs were not necessarily judged
+CAPPED_MARK = "[CAPPED]"
+# Lines the keyword/regex tiers of log_rules.py decide (before the verdict
+# cache, so rule verdicts always win) are not sent to the model, except
+# AUDIT_PERCENT of them, whose LLM verdicts measure the rules' agreement and
+# recall (written to OUTPUT_FILE + ".rules_audit.json").
+RULES = True
+AUDIT_PERCENT = 5
 
 @contextlib.contextmanager
 def suppress_stdout():
@@ -111,34 +161,152 @@ def construct_prompt(batch_items):
     """
     return prompt
 
+# Set on Ctrl-C: workers stop retrying and streaming once their current read returns
+_interrupted = threading.Event()
+
+def llm_options():
+    options = dict(LLM_OPTIONS)
+    if LLM_MAX_TOKENS > 0:
+        options["num_predict"] = LLM_MAX_TOKENS
+    return options
+
 def call_llm(prompt, retry=3):
-    log(f"prompt: {prompt}")
+    debug("prompt: %s", prompt)
     payload = {
         "model": MODEL,
         "prompt": prompt,
         "stream": False,
-        "options": {
-            "temperature": 0.3,
-            "top_p": 0.3,
-            "num_ctx": 8192 
-        }
+        "options": llm_options()
     }
     
+    read_timeout = min(LLM_TIMEOUT, LLM_MAX_SECONDS) if LLM_MAX_SECONDS else LLM_TIMEOUT
     for attempt in range(retry):
+        if _interrupted.is_set():
+            return None
         try:
-            response = requests.post(OLLAMA_URL, json=payload, timeout=600) # Increased timeout for batch
+            response = http_session.post(OLLAMA_URL, json=payload, read_timeout=read_timeout)
             if response.status_code == 200:
                 result = response.json()
-                return result.get("response", "").strip()
+                text = result.get("response", "").strip()
+                if result.get("done_reason") == "length":
+                    text += "\n" + CAPPED_MARK
+                return text
             else:
                 log(f"Error from Ollama (Attempt {attempt+1}): {response.status_code} - {response.text}")
                 time.sleep(2)
         except Exception as e:
+            if LLM_MAX_SECONDS and isinstance(e, requests.Timeout):
+                # A retry would take just as long
+                log(f"  [x] Batch hit the {LLM_MAX_SECONDS}s cap without streaming, no lines to keep")
+                return None
             log(f"Exception calling Ollama (Attempt {attempt+1}): {e}")
             time.sleep(2)
     
     return None
 
+def read_stream(response, on_line=None, start=None):
+    """
+    Collect the text of a streamed /api/generate response. Each complete
+    answer line (outside <think> blocks) is passed to on_line; reading stops
+    at a first answer of NONE, at the end of the generation, or after
+    LLM_MAX_SECONDS.
+    """
+    start = start or time.time()
+    pieces = []
+    pending = ""
+    in_think = False
+    answer_lines = 0
+
+    def handle(line):
+        # True when the rest of the generation is not needed
+        nonlocal in_think, answer_lines
+        line = line.strip()
+        if line.startswith("<think>"):
+            in_think = True
+        if in_think:
+            if "</think>" in line:
+                in_think = False
+            return False
+        if not line:
+            return False
+        answer_lines += 1
+        if answer_lines == 1 and line in ("NONE", "'NONE'"):
+            return True
+        if on_line:
+            on_line(line)
+        return False
+
+    for raw in response.iter_lines():
+        if not raw:
+            continue
+        chunk = json.loads(raw)
+        piece = chunk.get("response", "")
+        pieces.append(piece)
+        pending += piece
+        if "\n" in pending:
+            *complete, pending = pending.split("\n")
+            if any(handle(line) for line in complete):
+                debug("NONE answer, stopping generation early")
+                break
+        if chunk.get("done"):
+            if pending:
+                handle(pending)
+            if chunk.get("done_reason") == "length":
+                log(f"  [x] Batch hit the {LLM_MAX_TOKENS} token cap, keeping the lines finished so far")
+                pieces.append("\n" + CAPPED_MARK)
+            break
+        if _interrupted.is_set():
+            break
+        if LLM_MAX_SECONDS and time.time() - start > LLM_MAX_SECONDS:
+            log(f"  [x] Batch hit the {LLM_MAX_SECONDS}s cap, keeping the lines finished so far")
+            pieces.append("\n" + CAPPED_MARK)
+            break
+    return "".join(pieces).strip()
+
+def call_llm_stream(prompt, on_line=None, retry=3):
+    """call_llm with "stream": True; on_line gets each complete answer line."""
+    debug("prompt: %s", prompt)
+    payload = {
+        "model": MODEL,
+        "prompt": prompt,
+        "stream": True,
+        "options": llm_options()
+    }
+
+    for attempt in range(retry):
+        if _interrupted.is_set():
+            return None
+        try:
+            start = time.time()
+            # Leaving the with block early closes the connection, which makes
+            # Ollama abandon the rest of the generation.
+            with http_session.post(OLLAMA_URL, json=payload, read_timeout=LLM_TIMEOUT, stream=True) as response:
+                if response.status_code == 200:
+                    return read_stream(response, on_line, start)
+                log(f"Error from Ollama (Attempt {attempt+1}): {response.status_code} - {response.text}")
+            time.sleep(2)
+        except Exception as e:
+            log(f"Exception calling Ollama (Attempt {attempt+1}): {e}")
+            time.sleep(2)
+
+    return None
+
+_live_lock = threading.Lock()
+# Reasoning models (qwen3) think aloud first; an unterminated block is a cut-off answer.
+THINK_RE = re.compile(r"<think>.*?(?:</think>|$)", re.S)
+
+def live_path():
+    return LIVE_FILE or OUTPUT_FILE + ".live"
+
+def write_live(batch_items, res_line):
+    """Append one streamed SUSPICIOUS_ID line to the live file, in arrival order."""
+    found = parse_batch_result(batch_items, res_line)
+    if not found:
+        return
+    with _live_lock, open(live_path(), 'a', encoding='utf-8') as live_f:
+        for log_id, original_log, reason in found:
+            live_f.write(f"{log_id}\t{original_log}\t{reason}\n")
+
 def analyze_batch(batch_items, retry=3):
     """
     batch_items: list of dicts {'id': int, 'line': str}
@@ -147,12 +315,315 @@ def analyze_batch(batch_items, retry=3):
         return []
 
     prompt = construct_prompt(batch_items)
+    if LLM_STREAM:
+        # Audited lines were already decided by the rules
+        live_items = [item for item in batch_items if not item.get('audit')]
+        def on_line(line):
+            if line.startswith("SUSPICIOUS_ID:"):
+                write_live(live_items, line)
+        return call_llm_stream(prompt, on_line, retry)
     return call_llm(prompt, retry)
 
+def count_tokens(splitter, line):
+    try:
+        with suppress_stdout():
+            return splitter.tokenize(line)
+    except Exception:
+        try:
+            return splitter.tokenize(line)
+        except Exception:
+            return 10 # Fallback estimate
+
+def count_all_tokens(splitter, lines, offline=False):
+    """Token count per line, in as few (cached) tokenizer requests as possible."""
+    if offline:
+        return [splitter.estimator.upper(line) for line in lines]
+    try:
+        with suppress_stdout():
+            return splitter.tokenize_batch(lines)
+    except Exception as e:
+        log(f"Batch tokenization failed ({e}), counting line by line")
+        return [count_tokens(splitter, line) for line in lines]
+
+def iter_batches(items, token_counts):
+    """
+    items: list of dicts {'id': int, 'line': str}
+    Yield (batch_items, batch_tokens), each batch within BATCH_TOKEN_LIMIT.
+    """
+    current_batch = []
+    current_batch_tokens = 0
+    # We use a rough estimate: existing tokens + new line tokens + overhead per line (e.g. 10 tokens for ID prefix)
+    line_overhead = 10
+    for item, token_count in zip(items, token_counts):
+        if current_batch and (current_batch_tokens + token_count + line_overhead > BATCH_TOKEN_LIMIT):
+            yield current_batch, current_batch_tokens
+            current_batch = []
+            current_batch_tokens = 0
+        current_batch.append(item)
+        current_batch_tokens += token_count
+    if current_batch:
+        yield current_batch, current_batch_tokens
+
+def parse_batch_result(batch_items, analysis_result):
+    """
+    [(log_id, line, reason)] for the suspicious logs of one batch, or None
+    if the model did not answer (no SUSPICIOUS_ID lines and no NONE).
+    """
+    answer = THINK_RE.sub("", analysis_result or "")
+    result_lines = [l.strip() for l in answer.split('\n')]
+    answered = any(l.startswith("SUSPICIOUS_ID:") or l == "NONE" or l == "'NONE'" for l in result_lines)
+    if not answered:
+        return None
+    by_id = {item['id']: item['line'] for item in batch_items}
+    found = []
+    for res_line in result_lines:
+        if not res_line.startswith("SUSPICIOUS_ID:"):
+            continue
+        # Format: SUSPICIOUS_ID: <ID> | REASON: <reason>
+        try:
+            parts = res_line.split('|', 1)
+            id_part = parts[0].replace("SUSPICIOUS_ID:", "").strip()
+            reason_part = parts[1].replace("REASON:", "").strip() if len(parts) > 1 else "Unknown"
+            log_id = int(id_part)
+        except Exception as parse_e:
+            log(f"  [x] Error parsing result line: {res_line} ({parse_e})")
+            continue
+        original_log = by_id.get(log_id)
+        if original_log:
+            found.append((log_id, original_log, reason_part))
+    return found
+
+def write_report_header(date):
+    with open(OUTPUT_FILE, 'w', encoding='utf-8') as out_f:
+        out_f.write(f"Log Analysis Report (Batch Mode)\nDate: {date}\n")
+        out_f.write(f"Model: {MODEL}\n")
+        out_f.write(f"Source: {INPUT_FILE}\n")
+        out_f.write("-" * 50 + "\n\n")
+
+def write_entries(entries, note="", quiet=False):
+    """Append (log_id, line, reason) entries to OUTPUT_FILE."""
+    with open(OUTPUT_FILE, 'a', encoding='utf-8') as out_f:
+        for log_id, original_log, reason in entries:
+            if not quiet:
+                log(f"  [!] Found suspicious log ID {log_id}{note}")
+            out_f.write(f"Log ID {log_id}{note}:\n")
+            out_f.write(f"Content: {original_log}\n")
+            out_f.write(f"Analysis: {reason}\n")
+            out_f.write("-" * 30 + "\n")
+
+def journal_path():
+    return JOURNAL_FILE or OUTPUT_FILE + ".journal"
+
+def run_fingerprint(lines):
+    """Identifies the input/model/prompt a journal belongs to."""
+    h = hashlib.sha1()
+    for part in [MODEL, construct_prompt([]), json.dumps(LLM_OPTIONS, sort_keys=True)] + lines:
+        h.update(part.encode('utf-8', errors='surrogatepass') + b"\0")
+    return h.hexdigest()
+
+def append_journal(journal_f, record):
+    """One JSON line per record, on disk before the next batch is handled."""
+    journal_f.write(json.dumps(record, ensure_ascii=False) + "\n")
+    journal_f.flush()
+    os.fsync(journal_f.fileno())
+
+def read_journal(path):
+    """(start record, other records); a torn last line from a crash is dropped."""
+    start = None
+    records = []
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if record.get("type") == "start":
+                start = record
+            else:
+                records.append(record)
+    return start, records
+
+def journal_done_ids(records):
+    done = set()
+    for record in records:
+        if record.get("capped") and record.get("found") is not None:
+            # Only the lines the model got to; the rest are retried on resume
+            done.update(log_id for log_id, _ in record["found"])
+        elif record["type"] == "cached" or record.get("found") is not None:
+            done.update(record["ids"])
+    return done
+
+def rebuild_report(start, records, lines):
+    """
+    Rewrite OUTPUT_FILE (entries in log ID order) and OUTPUT_FAIL_FILE
+    (batches still unanswered) from the journal. Returns the suspicious count.
+    """
+    entries = {}
+    notes = {"cached": " (cached)", "rules": " (rule)"}
+    for record in records:
+        note = notes.get(record["type"], "")
+        for log_id, reason in record.get("found") or []:
+            entries[log_id] = (reason, note)
+    write_report_header(start["date"])
+    for log_id in sorted(entries):
+        reason, note = entries[log_id]
+        write_entries([(log_id, lines[log_id - 1], reason)], note, quiet=True)
+    done = journal_done_ids(records)
+    with open(OUTPUT_FAIL_FILE, 'w', encoding='utf-8') as fail_f:
+        for record in records:
+            if record["type"] == "batch" and (record.get("found") is None or record.get("capped")):
+                for log_id in record["ids"]:
+                    if log_id not in done:
+                        fail_f.write(f"{lines[log_id - 1]}\n")
+    return len(entries)
+
+def write_batch_result(batch_items, analysis_result, audit_ids=()):
+    """
+    Append the suspicious logs of one batch to OUTPUT_FILE. Batches the
+    model did not answer, and the unlisted logs of a capped answer, go to
+    OUTPUT_FAIL_FILE. Logs in audit_ids (already decided by the rules) are
+    left out of both.
+    Returns the parsed entries, or None for an unanswered batch.
+    """
+    found = parse_batch_result(batch_items, analysis_result)
+    if found is None:
+        log(f"  [x] No usable answer for batch starting at ID {batch_items[0]['id']}, written to {OUTPUT_FAIL_FILE}")
+        unjudged = batch_items
+    elif is_capped(analysis_result):
+        listed = {entry[0] for entry in found}
+        unjudged = [item for item in batch_items if item['id'] not in listed]
+    else:
+        unjudged = []
+    if unjudged:
+        with open(OUTPUT_FAIL_FILE, 'a', encoding='utf-8') as fail_f:
+            for item in unjudged:
+                if item['id'] not in audit_ids:
+                    fail_f.write(f"{item['line']}\n")
+    if found is None:
+        return None
+    write_entries([entry for entry in found if entry[0] not in audit_ids])
+    return found
+
+def is_capped(analysis_result):
+    return (analysis_result or "").endswith(CAPPED_MARK)
+
+def batch_verdicts(batch_items, found, capped=False):
+    """
+    (line, verdict, reason) for every log of an answered batch; only the
+    suspicious ones if the answer was capped.
+    """
+    reasons = {log_id: reason for log_id, _, reason in found}
+    return [(item['line'], verdict_cache.SUSPICIOUS, reasons[item['id']]) if item['id'] in reasons
+            else (item['line'], verdict_cache.CLEAN, None) for item in batch_items
+            if item['id'] in reasons or not capped]
+
+def open_verdict_cache():
+    template = construct_prompt([])
+    return verdict_cache.VerdictCache(verdict_cache.VERDICT_CACHE_DB, MODEL,
+                                      verdict_cache.prompt_hash(template, json.dumps(LLM_OPTIONS, sort_keys=True)))
+
+def in_audit_sample(line, percent):
+    """Stable per-line choice, so a resumed or repeated run audits the same lines."""
+    return zlib.crc32(line.encode('utf-8', errors='surrogatepass')) % 100 < percent
+
+def apply_rules(rules, items, audit_percent):
+    """
+    Classify items with the rule tiers. Returns the journal record of the
+    decided lines and the items left for the model; the audit sample of the
+    decided ones is among them, marked 'audit'.
+    """
+    record = {"type": "rules", "ids": [], "found": [], "cleared": []}
+    remaining = []
+    for item in items:
+        tier, name = rules.classify(item['line'])
+        if tier is None:
+            remaining.append(item)
+            continue
+        record["ids"].append(item['id'])
+        if tier == log_rules.SUSPICIOUS:
+            record["found"].append([item['id'], f"rule:{name}"])
+        else:
+            record["cleared"].append([item['id'], name])
+        if in_audit_sample(item['line'], audit_percent):
+            remaining.append(dict(item, audit=True))
+    return record, remaining
+
+def rules_audit(records, lines):
+    """
+    Rule verdicts against the LLM verdicts of the audited lines: precision of
+    the suspicious tier, misses of the benign tier and the rules' recall of
+    what the model flags.
+    """
+    flagged = {}
+    cleared = {}
+    audited = set()
+    llm = {}
+    for record in records:
+        if record["type"] == "rules":
+            flagged.update((log_id, reason) for log_id, reason in record["found"])
+            cleared.update((log_id, f"rule:{name}") for log_id, name in record["cleared"])
+        elif record["type"] == "batch" and record.get("audit_ids"):
+            audited.update(record["audit_ids"])
+            llm.update((log_id, reason) for log_id, reason in record["audit"])
+    audited &= set(flagged) | set(cleared)
+    audited_flagged = audited & set(flagged)
+    audited_cleared = audited & set(cleared)
+    llm_suspicious = audited & set(llm)
+    stats = {
+        "audited": len(audited),
+        "flagged": len(audited_flagged),
+        "flagged_confirmed": len(audited_flagged & llm_suspicious),
+        "cleared": len(audited_cleared),
+        "cleared_missed": len(audited_cleared & llm_suspicious),
+        "llm_suspicious": len(llm_suspicious),
+        "recall": len(audited_flagged & llm_suspicious) / len(llm_suspicious) if llm_suspicious else None,
+    }
+    disagreements = [{"id": log_id, "line": lines[log_id - 1], "rule": flagged.get(log_id) or cleared[log_id],
+                      "llm": llm.get(log_id)}
+                     for log_id in sorted((audited_flagged - llm_suspicious) | (audited_cleared & llm_suspicious))]
+    return stats, disagreements
+
+def format_rules_audit(stats):
+    recall = "n/a" if stats["recall"] is None else f"{stats['recall'] * 100:.1f}%"
+    return (f"Rules audit: {stats['audited']} lines checked by the model; "
+            f"suspicious tier {stats['flagged_confirmed']}/{stats['flagged']} confirmed, "
+            f"benign tier {stats['cleared_missed']}/{stats['cleared']} missed, recall {recall}")
+
+def leave_interrupted():
+    """
+    Process exit for a script whose main() raised SystemExit(INTERRUPTED_EXIT):
+    workers still blocked in a request would be joined at interpreter exit
+    (up to LLM_TIMEOUT), so leave without waiting for them.
+    """
+    logger.shutdown()
+    os._exit(INTERRUPTED_EXIT)
+
 def main():
+    global LLM_STREAM, LLM_MAX_TOKENS, LLM_MAX_SECONDS
     parser = argparse.ArgumentParser(description="Analyze logs using Ollama in batches.")
     parser.add_argument("--limit", type=int, default=0, help="Limit number of lines to process")
+    parser.add_argument("--offline-tokens", action="store_true", default=OFFLINE_TOKENS,
+                        help="count tokens with the local estimator, no tokenizer requests")
+    parser.add_argument("--no-verdict-cache", action="store_true", default=not VERDICT_CACHE,
+                        help="send every line to the model, ignoring and not updating the verdict cache")
+    parser.add_argument("--resume", action="store_true", default=RESUME,
+                        help="continue an interrupted run from its journal instead of starting over")
+    parser.add_argument("--no-stream", action="store_true", default=not LLM_STREAM,
+                        help="wait for each complete response instead of streaming it")
+    parser.add_argument("--max-tokens", type=int, default=LLM_MAX_TOKENS, help="generated tokens per batch (0 = no cap)")
+    parser.add_argument("--max-seconds", type=float, default=LLM_MAX_SECONDS,
+                        help="seconds per streamed batch (0 = no cap)")
+    parser.add_argument("--no-rules", action="store_true", default=not RULES,
+                        help="send every uncached line to the model, skipping the rule tiers")
+    parser.add_argument("--audit-percent", type=float, default=AUDIT_PERCENT,
+                        help="percent of rule-decided lines still sent to the model to check the rules")
+    parser.add_argument("--parallel", type=int, default=PARALLEL_BATCHES,
+                        help="batches in flight at once (match OLLAMA_NUM_PARALLEL on the server)")
     args = parser.parse_args()
+    LLM_STREAM = not args.no_stream
+    LLM_MAX_TOKENS = args.max_tokens
+    LLM_MAX_SECONDS = args.max_seconds
+    _interrupted.clear()
 
     # Initialize TokenSplitter
     try:
@@ -176,284 +647,136 @@ def main():
         lines = lines[:args.limit]
         log(f"Limiting analysis to first {args.limit} lines.")
 
-    log(f"Starting BATCH analysis of {len(lines)} lines using model {MODEL}...")
-    
-    suspicious_count = 0
-    start_time = time.time()
+    parallel = max(1, args.parallel)
+    if http_session.POOL_MAXSIZE < parallel:
+        # One pooled connection per batch in flight
+        http_session.configure(pool_maxsize=parallel)
+    log(f"Starting BATCH analysis of {len(lines)} lines using model {MODEL} ({parallel} batches in flight)...")
     
-    # Initialize output file (Write header)
-    with open(OUTPUT_FILE, 'w', encoding='utf-8') as out_f:
-        out_f.write(f"Log Analysis Report (Batch Mode)\nDate: {time.strftime('%Y-%m-%d %H:%M:%S')}\n")
-        out_f.write(f"Model: {MODEL}\n")
-        out_f.write(f"Source: {INPUT_FILE}\n")
-        out_f.write("-" * 50 + "\n\n")
-
     suspicious_count = 0
     start_time = time.time()
-    
-    current_batch = []
-    current_batch_tokens = 0
-    
-    for i, line in enumerate(lines):
-        # 1. Count tokens
-        token_count = 0
-        try:
-            with suppress_stdout():
-                token_count = splitter.tokenize(line)
-        except Exception:
-            try:
-                token_count = splitter.tokenize(line)
-            except Exception:
-                token_count = 10 # Fallback estimate
-        
-        # 2. Check if batch is full
-        # We use a rough estimate: existing tokens + new line tokens + overhead per line (e.g. 10 tokens for ID prefix)
-        line_overhead = 10
-        if current_batch and (current_batch_tokens + token_count + line_overhead > BATCH_TOKEN_LIMIT):
-            # Process current batch
-            log(f"Processing batch of {len(current_batch)} logs ({current_batch_tokens} tokens)...")
-            analysis_result = analyze_batch(current_batch)
-            log(f"analysis_result: {analysis_result}")
-            if analysis_result:
-                # Parse and write results immediately (Append mode)
-                with open(OUTPUT_FILE, 'a', encoding='utf-8') as out_f:
-                    log(f"analysis_result_len: {len(analysis_result.split('\n'))}")
-                    for res_line in analysis_result.split('\n'):
-                        res_line = res_line.strip()
-                        if res_line.startswith("SUSPICIOUS_ID:"):
-                            # Extract ID and Reason
-                            # Format: SUSPICIOUS_ID: <ID> | REASON: <reason>
-                            try:
-                                parts = res_line.split('|', 1)
-                                id_part = parts[0].replace("SUSPICIOUS_ID:", "").strip()
-                                reason_part = parts[1].replace("REASON:", "").strip() if len(parts) > 1 else "Unknown"
-                                
-                                log_id = int(id_part)
-                                
-                                # Find original log
-                                original_log = next((item['line'] for item in current_batch if item['id'] == log_id), None)
-                                
-                                if original_log:
-                                    suspicious_count += 1
-                                    log(f"  [!] Found suspicious log ID {log_id}")
-                                    out_f.write(f"Log ID {log_id}:\n")
-                                    out_f.write(f"Content: {original_log}\n")
-                                    out_f.write(f"Analysis: {reason_part}\n")
-                                    out_f.write("-" * 30 + "\n")
-                            except Exception as parse_e:
-                                log(f"  [x] Error parsing result line: {res_line} ({parse_e})")
-                        else:
-                            with open(OUTPUT_FAIL_FILE, 'a', encoding='utf-8') as out_f:
-                                failed_batch = "\n".join(current_batch)
-                                out_f.write(f"{failed_batch}\n")
-            # Clear batch
-            current_batch = []
-            current_batch_tokens = 0
-        
-        # Add to batch
-        current_batch.append({'id': i + 1, 'line': line})
-        current_batch_tokens += token_count
-        
-    # Process final batch
-    if current_batch:
-        log(f"Processing final batch of {len(current_batch)} logs...")
-        analysis_result = analyze_batch(current_batch)
-        log(f"analysis_result: {analysis_result}")
-        if analysis_result:
-             with open(OUTPUT_FILE, 'a', encoding='utf-8') as out_f:
-                for res_line in analysis_result.split('\n'):
-                    res_line = res_line.strip()
-                    if res_line.startswith("SUSPICIOUS_ID:"):
-                        try:
-                            parts = res_line.split('|', 1)
-                            id_part = parts[0].replace("SUSPICIOUS_ID:", "").strip()
-                            reason_part = parts[1].replace("REASON:", "").strip() if len(parts) > 1 else "Unknown"
-                            log_id = int(id_part)
-                            original_log = next((item['line'] for item in current_batch if item['id'] == log_id), None)
-                            if original_log:
-                                suspicious_count += 1
-                                log(f"  [!] Found suspicious log ID {log_id}")
-                                out_f.write(f"Log ID {log_id}:\n")
-                                out_f.write(f"Content: {original_log}\n")
-                                out_f.write(f"Analysis: {reason_part}\n")
-                                out_f.write("-" * 30 + "\n")
-                        except Exception:
-                            pass
+    items = [{'id': i + 1, 'line': line} for i, line in enumerate(lines)]
+    fingerprint = run_fingerprint(lines)
+    journal = journal_path()
+    start = None
+    if args.resume and os.path.exists(journal):
+        start, records = read_journal(journal)
+        if start is None or start.get("fingerprint") != fingerprint:
+            log(f"Journal {journal} is for a different input, model or prompt; starting over.")
+            start = None
+        else:
+            done = journal_done_ids(records)
+            items = [item for item in items if item['id'] not in done]
+            suspicious_count = rebuild_report(start, records, lines)
+            log(f"Resuming: {len(done)} lines already done ({suspicious_count} suspicious), {len(items)} left.")
+    if start is None:
+        start = {"type": "start", "fingerprint": fingerprint, "date": time.strftime('%Y-%m-%d %H:%M:%S'),
+                 "input": INPUT_FILE, "model": MODEL, "lines": len(lines)}
+        with open(journal, 'w', encoding='utf-8') as journal_f:
+            append_journal(journal_f, start)
+        # Initialize output file (Write header)
+        write_report_header(start["date"])
+        open(OUTPUT_FAIL_FILE, 'w').close()
+        open(live_path(), 'w').close()
+    journal_f = open(journal, 'a', encoding='utf-8')
+
+    if not args.no_rules and items:
+        rules = log_rules.RuleSet.load()
+        record, items = apply_rules(rules, items, args.audit_percent)
+        write_entries([(log_id, lines[log_id - 1], reason) for log_id, reason in record["found"]], " (rule)")
+        append_journal(journal_f, record)
+        suspicious_count += len(record["found"])
+        audit = sum(1 for item in items if item.get('audit'))
+        log(f"Rules: {len(record['found'])} suspicious, {len(record['cleared'])} benign, "
+            f"{len(items) - audit} left for the model (+{audit} audited)")
+
+    cache = None if args.no_verdict_cache else open_verdict_cache()
+    if cache and items:
+        # Audited lines go to the model whatever the cache holds
+        lookup = [item for item in items if not item.get('audit')]
+        cached = cache.get_many([item['line'] for item in lookup])
+        hit_items = [item for item in lookup if item['line'] in cached]
+        found = [(item['id'], item['line'], cached[item['line']][1]) for item in hit_items
+                 if cached[item['line']][0] == verdict_cache.SUSPICIOUS]
+        # Cached suspicious logs first, then the model's answers for the rest
+        write_entries(found, " (cached)")
+        append_journal(journal_f, {"type": "cached", "ids": [item['id'] for item in hit_items],
+                                   "found": [[log_id, reason] for log_id, _, reason in found]})
+        suspicious_count += len(found)
+        items = [item for item in items if item.get('audit') or item['line'] not in cached]
+        log(cache.format_stats())
+
+    token_counts = count_all_tokens(splitter, [item['line'] for item in items], args.offline_tokens)
+    log(f"Token counts ready in {time.time() - start_time:.2f} seconds.")
+
+    # Results are written strictly in batch order, waiting on the oldest one first.
+    in_flight = deque()
+
+    def finish_oldest():
+        batch_items, future = in_flight.popleft()
+        analysis_result = future.result()
+        debug("analysis_result: %s", analysis_result)
+        audit_ids = {item['id'] for item in batch_items if item.get('audit')}
+        found = write_batch_result(batch_items, analysis_result, audit_ids)
+        capped = is_capped(analysis_result)
+        record = {"type": "batch", "ids": [item['id'] for item in batch_items],
+                  "found": None if found is None else
+                  [[log_id, reason] for log_id, _, reason in found if log_id not in audit_ids],
+                  "capped": capped}
+        if audit_ids and found is not None and not capped:
+            # A capped answer did not necessarily judge the audited lines
+            record["audit_ids"] = sorted(audit_ids)
+            record["audit"] = [[log_id, reason] for log_id, _, reason in found if log_id in audit_ids]
+        append_journal(journal_f, record)
+        if found is None:
+            return 0
+        if cache:
+            cache.put_many(batch_verdicts(batch_items, found, capped))
+        return len(record["found"])
+
+    pool = ThreadPoolExecutor(max_workers=parallel)
+    try:
+        for batch_items, batch_tokens in iter_batches(items, token_counts):
+            log_limited("llm.batch", "Processing batch of %d logs (%d tokens)...", len(batch_items), batch_tokens,
+                        interval=BATCH_LOG_INTERVAL)
+            in_flight.append((batch_items, pool.submit(analyze_batch, batch_items)))
+            if len(in_flight) >= parallel:
+                suspicious_count += finish_oldest()
+        while in_flight:
+            suspicious_count += finish_oldest()
+    except KeyboardInterrupt:
+        # Don't wait for the batches in flight; they are redone on resume.
+        _interrupted.set()
+        pool.shutdown(wait=False, cancel_futures=True)
+        journal_f.close()
+        log(f"\nInterrupted. Finished batches are in {journal}; rerun with --resume to continue.")
+        logger.flush()
+        raise SystemExit(INTERRUPTED_EXIT)
+    pool.shutdown()
+    journal_f.close()
+
+    # Final report in log ID order, from everything journaled (this run and earlier ones)
+    start, records = read_journal(journal)
+    suspicious_count = rebuild_report(start, records, lines)
+    audit_stats, disagreements = rules_audit(records, lines)
+    if audit_stats["audited"]:
+        with open(OUTPUT_FILE + ".rules_audit.json", 'w', encoding='utf-8') as audit_f:
+            json.dump({"stats": audit_stats, "disagreements": disagreements}, audit_f, ensure_ascii=False, indent=1)
 
     duration = time.time() - start_time
     log(f"\n\nBatch Analysis complete in {duration:.2f} seconds.")
     log(f"Total lines processed: {len(lines)}")
     log(f"Suspicious logs found: {suspicious_count}")
+    if cache:
+        log(cache.format_stats())
+    if audit_stats["audited"]:
+        log(format_rules_audit(audit_stats))
     log(f"Results saved to: {OUTPUT_FILE}")
 
 if __name__ == "__main__":
-    # main()
-    prompt = """
-               你是一名【资深系统 / 多媒体 / 驱动层日志分析专家】。
-
-        我将提供一批日志，每条日志都有唯一的 ID。
-        你的任务是从中识别所有表示【错误、失败、崩溃风险或严重异常】的日志。
-
-        ====================
-        【一、必须识别的异常类型】
-        ====================
-
-        只要日志语义符合以下任一情况，必须判定为“可疑日志”：
-
-        1. 明确错误或失败
-        - error / ERROR
-        - fail / failed / failure
-
-        2. 隐式失败（即使没有 ERROR 关键字）
-        - open / read / write / ioctl / call / get 等系统或驱动操作失败
-        - 资源获取失败（device / vdec / fd / buffer / memory）
-
-        3. 参数或状态非法
-        - NULL / null
-        - invalid
-        - incorrect / incorrent（包括拼写错误）
-        - mismatch / not match
-        - illegal
-
-        4. 不支持或不兼容
-        - do not support
-        - unsupported
-        - unknown format / type
-
-        5. 数据或内存异常（高风险，接近 CRASH）
-        - overflow
-        - overwrite / over writed
-        - corrupted / corruption
-        - wrong marker
-        - data lost / data gap
-
-        6. 可能导致系统不稳定或崩溃的异常
-        - 数据一致性异常
-        - 状态机错误
-        - 解码/同步异常（PTS / frame / buffer）
-
-        ⚠️ 特别强调：
-        - 包含 “NULL、failed” 的日志，必须视为严重错误
-        - 包含 “overflow / overwrite / wrong marker” 的日志，必须视为高风险问题
-        - incorrect / incorrent 在系统或多媒体日志中，默认视为逻辑或数据错误
-        
-        ====================
-        【二、必须忽略的日志】
-        ====================
-
-        以下日志必须忽略，不得误报：
-
-        - 正常的初始化、构造、析构流程
-        - 纯状态打印（无失败语义）
-        - 成功或完成类信息（success / done）
-        - 无后果的普通提示或已恢复警告
-        
-        Logs:
-        ID:801 | LOG:kWhatStopAudio mAdSoftWrap.clear()
-ID:802 | LOG:kWhatStopAudio mAdSoftWrap = NULL
-ID:803 | LOG:kWhatStopAudio mAdAdecWrap->Stop()
-ID:804 | LOG:kWhatStopAudio mAdAdecWrap->Release()
-ID:805 | LOG:kWhatStopAudio mAdAdecWrap.clear()
-ID:806 | LOG:kWhatStopAudio mAdAdecWrap = NULL
-ID:807 | LOG:kWhatStopVideo mDemuxWrap.AmDemuxWrapperStop(vpid:0x%x)
-ID:808 | LOG:kWhatUpdateAudioStatus auio_change ch=%u ch_mask=%u samp=%u
-ID:809 | LOG:kWhatUpdateHandlerStatus first get CheckinVpts:%
-ID:810 | LOG:kWhatUpdateHandlerStatus  get CheckinVpts:%
-ID:811 | LOG:DATA_LOSS mLastCheckinVpts:%
-ID:812 | LOG:DATA_RESUME
-ID:813 | LOG:DECODER_DATA_LOSS mLastFrameCount:%d dqbufFailCount:%d mVideoEsInvalid:%d
-ID:814 | LOG:DECODER_DATA_RESUME
-ID:815 | LOG:kWhatUpdateHandlerStatus first get checkinApts:%
-ID:816 | LOG:kWhatUpdateHandlerStatus get checkinApts:%
-ID:817 | LOG:DATA_LOSS mLastCheckinApts:%
-ID:818 | LOG:DECODER_DATA_LOSS mLastCheckoutApts:%
-ID:819 | LOG:pause find stream_type : %d
-ID:820 | LOG:pause in ,stream_type: %d
-ID:821 | LOG:mVdNonTunnelMode->Pause() finished
-ID:822 | LOG:pause finished
-ID:823 | LOG:pause out ,stream_type: %d
-ID:824 | LOG:resume find stream_type : %d
-ID:825 | LOG:resume in ,stream_type: %d
-ID:826 | LOG:mVdNonTunnelMode->Resume finished
-ID:827 | LOG:resume finished
-ID:828 | LOG:resume out ,stream_type: %d
-ID:829 | LOG:type %d fmt %d
-ID:830 | LOG:UnsupportedFormat format: %s
-ID:831 | LOG:USERDATA param nullptr
-ID:832 | LOG:VIDEO FORMAT CHANGED [%d x %d] @%d aspectratio:%d
-ID:833 | LOG:VIDEO FORMAT param %p, paramsize %d
-ID:834 | LOG:AUDIO FORMAT CHANGED ch=%u ch_mask=%u samplerate=%u
-ID:835 | LOG:AUDIO FORMAT param %p, paramsize %d
-ID:836 | LOG:event type: %s
-ID:837 | LOG:isStopVideo:%d,display first video
-ID:838 | LOG:isStopVideo:%d,decodec first video
-ID:839 | LOG:mStopAudio:%d,decodec first audio
-ID:840 | LOG:isStopVideo:%d,mStopAudio:%d,av sync done!
-ID:841 | LOG:isStopVideo:%d,frame error count callback
-ID:842 | LOG:isStopVideo:%d,video unsupport
-ID:843 | LOG:instance was preempted!
-ID:844 | LOG:hasdtvvideo:%d mStopVideo:%d mStopAudio:%d. decoder started!
-ID:845 | LOG:FFFB VIDEO TIMESTAMP param %p, paramsize %d
-ID:846 | LOG:Reset playback pipeline!
-ID:847 | LOG:dmx:%p
-ID:848 | LOG:audio pid: %#x
-ID:849 | LOG:EsDataHandler SetVideoLoopEnable:%d
-ID:850 | LOG:EsDataHandler
-ID:851 | LOG:Not get %s pts info, set cache to %dms
-ID:852 | LOG:Update video cache duration: %d ms
-ID:853 | LOG:EsDataHandler ReadBuffer Video Stop!!
-ID:854 | LOG:mEsdata->size == 0
-ID:855 | LOG:Audio write VDA_RETRY
-ID:856 | LOG:Audio write to amadec VDA_RETRY
-ID:857 | LOG:EsDataHandler ReadBuffer Audio Stop!!
-ID:858 | LOG:input parameter was NULL, init_stb_trace failed!
-ID:859 | LOG:input parameter was NULL, stb_trace_dbg failed!
-ID:860 | LOG:[%s][%d] step: No-%d %s, time: %u, consume: %u
-ID:861 | LOG:input parameter was NULL, AmTsPlayer_getPropertyInt failed!
-ID:862 | LOG:input parameter was NULL, AmTsPlayer_propertyGet failed!
-ID:863 | LOG:Unregistering stale handler %d
-ID:864 | LOG:blackout:%d
-ID:865 | LOG:release mVideoDecNonTunneLooper.clear
-ID:866 | LOG:in mode:%d vid:%d
-ID:867 | LOG:[No-%d](%p) %s start
-ID:868 | LOG:[No-%d](%p) %s report video stuck event
-ID:869 | LOG:[No-%d](%p) %s return
-ID:870 | LOG:mRender == NULL
-ID:871 | LOG:in OnFlush mQueuedSlot.size():%d
-ID:872 | LOG:mVPid:0x%x mVideoMime:%s
-ID:873 | LOG:mState == STOPPED return
-ID:874 | LOG:mDisplay.reset %p
-ID:875 | LOG:---->Render first frame mediaTimeUs:%
-ID:876 | LOG:---->Render Av Sync Done !
-ID:877 | LOG:kWhatQueueOutPutNotify NoFind,timestampNs(%
-ID:878 | LOG:kWhatStop mState:%d return
-ID:879 | LOG:kWhatStop onStop
-ID:880 | LOG:kWhatFlush vpid:%d
-ID:881 | LOG:kWhatFlush mState:%d, mNeedFlush:%d
-ID:882 | LOG:mVideoMime:%s, single demux only audio
-ID:883 | LOG:mVideoMime:%s, size > 64!
-ID:884 | LOG:not mInit
-ID:885 | LOG:return not STARTED(%d) mState:%d
-ID:886 | LOG:bufnum %d, width %d, height %d,mDqWidth:%d,mDqHeight:%d
-ID:887 | LOG:RequestBuffer, slot:%d is null
-ID:888 | LOG:createOutputBuffer slot:%d i:%d
-ID:889 | LOG:createOutputBuffer slot:%d to surface!i:%d
-ID:890 | LOG:createOutputBuffer slot:%d decode!i:%d
-ID:891 | LOG:can not find bitstreamId %d
-ID:892 | LOG:RegisterCb pFunc:%p disPlayHandle:%p
-ID:893 | LOG:info %p, size %d
-ID:894 | LOG:error %d
-ID:895 | LOG:VIDEO FORMAT CHANGED [%d x %d] @%d fps
-ID:896 | LOG:pthread_create ok DequeueDisPlayerBufferThread:%ld
-
-        ====================
-        【三、输出格式（严格要求）】
-        ====================
-
-        对于每一条可疑日志，必须严格按照以下格式换行输出（保留大写关键字）：
-        输出格式：
-        SUSPICIOUS_ID: <ID> | REASON: <简要说明原因>
-        如果本批次中没有可疑日志，请仅回复 'NONE'。
-    """
-    response = call_llm(prompt)
-    print(response)
+    try:
+        main()
+    except SystemExit as e:
+        if e.code != INTERRUPTED_EXIT:
+            raise
+        leave_interrupted()
@@ -0,0 +1,124 @@
+import os
+import re
+import json
+import argparse
+from logger import log
+
+# Deterministic first tier of step 5: keyword/regex rules taken from the
+# signals listed in llm_analyze_logs.construct_prompt. A line matching only
+# suspicious rules is flagged, one matching only benign rules is cleared, and
+# everything else (no match, or both tiers) is left to the LLM.
+SUSPICIOUS = "suspicious"
+BENIGN = "benign"
+TIERS = (SUSPICIOUS, BENIGN)
+
+# Optional JSON file: {"rules": [{"name", "tier", "pattern"}], "disable": [names]}
+RULES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "log_rules.json")
+
+# Word boundaries that also split snake_case (DATA_LOSS) but not camelCase (dqbufFailCount)
+_L = r"(?<![A-Za-z])"
+_R = r"(?![A-Za-z])"
+
+DEFAULT_RULES = [
+    ("null", SUSPICIOUS, _L + r"null(?:ptr)?" + _R),
+    ("failed", SUSPICIOUS, _L + r"fail(?:ed|ure|s)?" + _R),
+    ("error", SUSPICIOUS, _L + r"errors?" + _R),
+    ("overflow", SUSPICIOUS, _L + r"overflow" + _R),
+    ("overwrite", SUSPICIOUS, _L + r"over[ _-]?writ(?:e|ed|ten)" + _R),
+    ("corrupted", SUSPICIOUS, _L + r"corrupt(?:ed|ion)?" + _R),
+    ("wrong_marker", SUSPICIOUS, _L + r"wrong[ _]marker" + _R),
+    ("data_lost", SUSPICIOUS, _L + r"data[ _](?:lost|loss|gap)" + _R),
+    ("invalid", SUSPICIOUS, _L + r"invalid" + _R),
+    ("illegal", SUSPICIOUS, _L + r"illegal" + _R),
+    ("mismatch", SUSPICIOUS, _L + r"(?:mismatch(?:ed)?|not[ _]match(?:ed)?)" + _R),
+    ("incorrect", SUSPICIOUS, _L + r"incorre[cn]t" + _R),
+    ("unsupported", SUSPICIOUS, _L + r"(?:unsupport(?:ed)?|(?:do |does |is )?not support(?:ed)?)" + _R),
+    ("unknown_format", SUSPICIOUS, _L + r"unknown[ _](?:format|type|codec)" + _R),
+    ("cannot", SUSPICIOUS, _L + r"(?:can ?not|can't|unable to)" + _R),
+    ("not_success", SUSPICIOUS, _L + r"not[ _](?:success(?:ful)?|ok|ready)" + _R),
+    ("success", BENIGN, _L + r"(?:succe(?:ss|ssful|ssfully|ed|eded)|ok)" + _R),
+    ("done", BENIGN, _L + r"(?:done|finished|completed?)" + _R),
+    # enter/exit/start... as the last word: "[No-%d](%p) %s start", "decoder started!"
+    ("lifecycle", BENIGN, _L + r"(?:enter|exit|start(?:ed)?|init(?:ed|ialized)?|created?|destroy(?:ed)?|constructor|destructor)[^A-Za-z]*$"),
+    ("version", BENIGN, _L + r"version" + _R),
+]
+
+class RuleSet:
+    def __init__(self, rules=DEFAULT_RULES):
+        self.rules = list(rules)
+        self.names = {}
+        self.tier_re = {}
+        for tier in TIERS:
+            parts = []
+            for name, rule_tier, pattern in self.rules:
+                if rule_tier != tier:
+                    continue
+                group = f"r{len(self.names)}"
+                self.names[group] = name
+                parts.append(f"(?P<{group}>{pattern})")
+            # One pass per tier; lastgroup names the rule that matched first
+            self.tier_re[tier] = re.compile("|".join(parts), re.IGNORECASE) if parts else None
+
+    @classmethod
+    def load(cls, path=RULES_FILE):
+        """DEFAULT_RULES adjusted by the rules file, if there is one."""
+        rules = list(DEFAULT_RULES)
+        if path and os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            disabled = set(data.get("disable", []))
+            extra = [(r["name"], r["tier"], r["pattern"]) for r in data.get("rules", [])]
+            names = {name for name, _, _ in extra}
+            for name, tier, _ in extra:
+                if tier not in TIERS:
+                    raise ValueError(f"Rule {name}: tier must be one of {TIERS}")
+            # A rule in the file replaces the default of the same name.
+            rules = [r for r in rules if r[0] not in disabled and r[0] not in names] + \
+                    [r for r in extra if r[0] not in disabled]
+        return cls(rules)
+
+    def match(self, text, tier):
+        tier_re = self.tier_re[tier]
+        m = tier_re.search(text) if tier_re else None
+        return self.names[m.lastgroup] if m else None
+
+    def classify(self, text):
+        """(SUSPICIOUS or BENIGN, rule name), or (None, None) when the LLM has to decide."""
+        suspicious = self.match(text, SUSPICIOUS)
+        benign = self.match(text, BENIGN)
+        if suspicious and not benign:
+            return SUSPICIOUS, suspicious
+        if benign and not suspicious:
+            return BENIGN, benign
+        return None, None
+
+def main():
+    ap = argparse.ArgumentParser(description="Classify log templates with the step 5 rule tiers.")
+    ap.add_argument("input", help="text file, one log per line (e.g. the step 4 txt)")
+    ap.add_argument("--rules", default=RULES_FILE)
+    ap.add_argument("--show", choices=[SUSPICIOUS, BENIGN, "ambiguous"], default="",
+                    help="print the lines of one class")
+    args = ap.parse_args()
+    rules = RuleSet.load(args.rules)
+    counts = {}
+    per_rule = {}
+    with open(args.input, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            tier, name = rules.classify(line)
+            tier = tier or "ambiguous"
+            counts[tier] = counts.get(tier, 0) + 1
+            if name:
+                per_rule[name] = per_rule.get(name, 0) + 1
+            if args.show == tier:
+                print(f"{name or '-'}\t{line}")
+    total = sum(counts.values()) or 1
+    for tier in (SUSPICIOUS, BENIGN, "ambiguous"):
+        log(f"{tier:10s} {counts.get(tier, 0):8d} ({counts.get(tier, 0) / total * 100:.1f}%)")
+    for name, count in sorted(per_rule.items(), key=lambda kv: -kv[1]):
+        log(f"  {name:16s} {count}")
+
+if __name__ == "__main__":
+    main()
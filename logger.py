@@ -0,0 +1,148 @@
+import os
+import sys
+import time
+import atexit
+import logging
+import threading
+import multiprocessing
+from queue import SimpleQueue
+from logging.handlers import QueueHandler, QueueListener
+
+# Shared by every script: log() writes the message as-is to stdout (and to
+# LOG_FILE with a timestamp). Records are handed to a background thread, so a
+# hot loop never waits on the terminal or the disk.
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+LOG_FILE = os.environ.get("LOG_FILE", "")
+
+DEBUG = logging.DEBUG
+INFO = logging.INFO
+WARNING = logging.WARNING
+ERROR = logging.ERROR
+
+_logger = logging.getLogger("print_code_extract")
+_logger.propagate = False
+_handlers = []
+_listener = None
+_lock = threading.Lock()
+# key -> [calls, last emit time, calls suppressed since last emit]
+_samples = {}
+
+def _make_handlers():
+    console = logging.StreamHandler(sys.stdout)
+    console.setFormatter(logging.Formatter("%(message)s"))
+    handlers = [console]
+    if LOG_FILE:
+        to_file = logging.FileHandler(LOG_FILE, encoding="utf-8")
+        to_file.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(processName)s %(message)s"))
+        handlers.append(to_file)
+    return handlers
+
+def _setup(background=True):
+    global _handlers, _listener
+    for h in list(_logger.handlers):
+        _logger.removeHandler(h)
+    _handlers = _make_handlers()
+    _listener = None
+    if background:
+        q = SimpleQueue()
+        _logger.addHandler(QueueHandler(q))
+        _listener = QueueListener(q, *_handlers, respect_handler_level=True)
+        _listener.start()
+    else:
+        for h in _handlers:
+            _logger.addHandler(h)
+
+def _direct_in_child():
+    # Worker processes may exit without running atexit, which would drop
+    # whatever is still queued, so they write synchronously.
+    global _listener
+    _listener = None
+    _setup(background=False)
+
+def shutdown():
+    """Flush queued records and stop the writer thread (also run at exit)."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+    for h in _handlers:
+        h.flush()
+
+def flush():
+    """Write out everything queued so far; logging goes on afterwards."""
+    if _listener is not None:
+        _listener.stop()
+        _listener.start()
+    for h in _handlers:
+        h.flush()
+
+def set_level(level):
+    """Level name ("DEBUG", "INFO", ...) or logging constant."""
+    if isinstance(level, str):
+        level = logging.getLevelName(level.upper())
+    _logger.setLevel(level)
+
+def add_file(path):
+    """Also write records to path, with timestamps."""
+    handler = logging.FileHandler(path, encoding="utf-8")
+    handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(processName)s %(message)s"))
+    _handlers.append(handler)
+    if _listener is not None:
+        _listener.handlers = tuple(_handlers)
+    else:
+        _logger.addHandler(handler)
+
+def debug_enabled():
+    return _logger.isEnabledFor(DEBUG)
+
+def log(msg, *args):
+    _logger.info(msg, *args)
+
+def debug(msg, *args):
+    # Pass values as args ("x=%s", x) so nothing is formatted when disabled.
+    _logger.debug(msg, *args)
+
+def info(msg, *args):
+    _logger.info(msg, *args)
+
+def warning(msg, *args):
+    _logger.warning(msg, *args)
+
+def error(msg, *args):
+    _logger.error(msg, *args)
+
+def _sample(key):
+    with _lock:
+        entry = _samples.get(key)
+        if entry is None:
+            entry = _samples[key] = [0, 0.0, 0]
+        entry[0] += 1
+        return entry
+
+def log_every(key, every, msg, *args, level=INFO):
+    """Per-row messages: log the 1st, (every+1)th, ... call for key, with the call count."""
+    if not _logger.isEnabledFor(level):
+        return
+    entry = _sample(key)
+    if every <= 1 or entry[0] % every == 1:
+        _logger.log(level, msg + " [%d so far]", *args, entry[0])
+
+def log_limited(key, msg, *args, interval=1.0, level=INFO):
+    """At most one message per interval seconds for key; the rest are counted, not written."""
+    if not _logger.isEnabledFor(level):
+        return
+    entry = _sample(key)
+    now = time.monotonic()
+    if entry[0] > 1 and now - entry[1] < interval:
+        entry[2] += 1
+        return
+    suppressed, entry[1], entry[2] = entry[2], now, 0
+    if suppressed:
+        _logger.log(level, msg + " [%d similar suppressed]", *args, suppressed)
+    else:
+        _logger.log(level, msg, *args)
+
+set_level(LOG_LEVEL)
+_setup(background=multiprocessing.parent_process() is None)
+os.register_at_fork(after_in_child=_direct_in_child)
+atexit.register(shutdown)
@@ -0,0 +1,204 @@
+import csv
+import os
+import sys
+import sqlite3
+import argparse
+
+import extract_log_content
+import clean_log_text
+from logger import log
+
+# One logset per database: step 1 rows in `logs`, one `templates` row per
+# unique cleaned text (the step 4 dedup groups) carrying the step 5 verdict.
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS logs (
+    id          INTEGER PRIMARY KEY,
+    file        TEXT NOT NULL,
+    line        INTEGER NOT NULL,
+    style       TEXT NOT NULL,
+    raw         TEXT NOT NULL,
+    extracted   TEXT,
+    cleaned     TEXT,
+    template_id INTEGER REFERENCES templates(id),
+    UNIQUE (file, line, style)
+);
+CREATE INDEX IF NOT EXISTS logs_style_file ON logs (style, file);
+CREATE INDEX IF NOT EXISTS logs_file ON logs (file);
+CREATE INDEX IF NOT EXISTS logs_template ON logs (template_id);
+CREATE TABLE IF NOT EXISTS templates (
+    id          INTEGER PRIMARY KEY,
+    text        TEXT NOT NULL UNIQUE,
+    first_log   INTEGER NOT NULL,
+    occurrences INTEGER NOT NULL,
+    verdict     TEXT,
+    reason      TEXT,
+    model       TEXT
+);
+"""
+
+def _keep_cleaned(text):
+    cleaned = clean_log_text.clean_text(text)
+    return cleaned if clean_log_text.should_keep_row(cleaned) else ""
+
+def open_logset(db_path):
+    conn = sqlite3.connect(db_path)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.executescript(SCHEMA)
+    # The step 2/3 transforms run inside UPDATE statements.
+    conn.create_function("extract_content", 1, extract_log_content.extract_content, deterministic=True)
+    conn.create_function("clean_keep", 1, _keep_cleaned, deterministic=True)
+    return conn
+
+def load_rows(conn, rows, batch_size=5000):
+    """Step 1: insert (file, line, style, text) rows, replacing the table contents."""
+    conn.execute("DELETE FROM logs")
+    conn.execute("DELETE FROM templates")
+    count = 0
+    batch = []
+    insert = "INSERT OR IGNORE INTO logs (file, line, style, raw) VALUES (?, ?, ?, ?)"
+    for r in rows:
+        batch.append((r[0], int(r[1]), r[2], r[3]))
+        if len(batch) >= batch_size:
+            conn.executemany(insert, batch)
+            count += len(batch)
+            batch = []
+    if batch:
+        conn.executemany(insert, batch)
+        count += len(batch)
+    conn.commit()
+    return count
+
+def load_csv(conn, csv_path):
+    csv.field_size_limit(sys.maxsize)
+    with open(csv_path, "r", newline="") as f:
+        reader = csv.reader(f)
+        next(reader, None)
+        return load_rows(conn, reader)
+
+def apply_extract(conn):
+    """Step 2 in place: first quoted string of each call."""
+    conn.execute("UPDATE logs SET extracted = extract_content(raw)")
+    conn.commit()
+
+def apply_clean(conn):
+    """Step 3 in place: cleaned text, or '' for rows clean_log_text filters out."""
+    conn.execute("UPDATE logs SET cleaned = clean_keep(extracted)")
+    conn.commit()
+
+def apply_dedup(conn):
+    """Step 4 in place: one template per unique cleaned text, in first-seen order."""
+    conn.execute("UPDATE logs SET template_id = NULL")
+    conn.execute("DELETE FROM templates")
+    conn.execute("""
+        INSERT INTO templates (text, first_log, occurrences)
+        SELECT cleaned, MIN(id), COUNT(*) FROM logs GROUP BY cleaned ORDER BY MIN(id)
+    """)
+    conn.execute("""
+        UPDATE logs SET template_id = (SELECT t.id FROM templates t WHERE t.text = logs.cleaned)
+    """)
+    conn.commit()
+    return conn.execute("SELECT COUNT(*) FROM templates").fetchone()[0]
+
+def export_templates(conn, txt_path):
+    """Write the unique texts one per line, like deduplicate_csv's txt output."""
+    count = 0
+    with open(txt_path, "w", encoding="utf-8", newline="") as f:
+        for (text,) in conn.execute("SELECT text FROM templates ORDER BY first_log"):
+            f.write(text + "\n")
+            count += 1
+    return count
+
+def answered_texts(input_path, fail_path, members_of=None):
+    """
+    Step 5 input lines the model (or the verdict cache / rule tiers) answered,
+    i.e. not left in the fail file, plus the cluster members of answered
+    representatives (members_of as from cluster_templates.load_clusters).
+    """
+    failed = set()
+    if fail_path and os.path.exists(fail_path):
+        with open(fail_path, "r", encoding="utf-8") as f:
+            failed = {line.strip() for line in f if line.strip()}
+    answered = set()
+    with open(input_path, "r", encoding="utf-8") as f:
+        for line in f:
+            text = line.strip()
+            if text and text not in failed:
+                answered.add(text)
+                answered.update((members_of or {}).get(text, []))
+    return answered
+
+def record_verdicts(conn, report_path, model=None, answered=None):
+    """
+    Step 5: mark templates listed in an llm_analyze_logs report as
+    SUSPICIOUS, and the other answered templates (texts in answered) as
+    CLEAN. Templates never analyzed keep a NULL verdict.
+    """
+    count = 0
+    content = None
+    # Step 5 strips every line, template texts keep their outer whitespace.
+    ids = {}
+    for template_id, text in conn.execute("SELECT id, text FROM templates"):
+        ids.setdefault(text.strip(), []).append(template_id)
+    with open(report_path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith("Content:"):
+                content = line[len("Content:"):].strip()
+            elif line.startswith("Analysis:") and content is not None:
+                reason = line[len("Analysis:"):].strip()
+                for template_id in ids.get(content, []):
+                    conn.execute("UPDATE templates SET verdict = 'SUSPICIOUS', reason = ?, model = ? WHERE id = ?",
+                                 (reason, model, template_id))
+                    count += 1
+                content = None
+    if answered:
+        clean = [(model, template_id) for text, template_ids in ids.items() if text in answered
+                 for template_id in template_ids]
+        conn.executemany("UPDATE templates SET verdict = 'CLEAN', reason = NULL, model = ? "
+                         "WHERE id = ? AND verdict IS NULL", clean)
+    conn.commit()
+    return count
+
+def query_rows(conn, style=None, directory=None):
+    """Rows of one log style and/or under one directory, with their verdict."""
+    sql = ["SELECT l.file, l.line, l.style, l.raw, l.cleaned, t.verdict, t.reason",
+           "FROM logs l LEFT JOIN templates t ON t.id = l.template_id WHERE 1 = 1"]
+    params = []
+    if style:
+        sql.append("AND l.style = ?")
+        params.append(style)
+    if directory:
+        # Prefix range instead of LIKE so the index is used.
+        prefix = directory.rstrip("/") + "/"
+        sql.append("AND l.file >= ? AND l.file < ?")
+        params.extend([prefix, prefix[:-1] + "0"])
+    sql.append("ORDER BY l.id")
+    return conn.execute(" ".join(sql), params).fetchall()
+
+def verdict_for(conn, text):
+    """(verdict, reason, occurrences) for a template text, or None."""
+    return conn.execute("SELECT verdict, reason, occurrences FROM templates WHERE text = ?",
+                        (text,)).fetchone()
+
+def main():
+    ap = argparse.ArgumentParser(description="Query a logset database built by pipeline_process_logs.py.")
+    ap.add_argument("db")
+    ap.add_argument("--style", default="")
+    ap.add_argument("--dir", default="")
+    ap.add_argument("--verdict", default="", help="look up the verdict of one template text")
+    args = ap.parse_args()
+    if not os.path.exists(args.db):
+        log(f"Database not found: {args.db}")
+        return
+    conn = open_logset(args.db)
+    if args.verdict:
+        log(f"{verdict_for(conn, args.verdict)}")
+        return
+    rows = query_rows(conn, args.style or None, args.dir or None)
+    for file, line, style, raw, cleaned, verdict, reason in rows:
+        print(f"{file}:{line}\t{style}\t{verdict or '-'}\t{cleaned}")
+    log(f"{len(rows)} rows")
+
+if __name__ == "__main__":
+    main()
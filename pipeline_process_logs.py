@@ -14,20 +14,86 @@ import clean_log_text
 import deduplicate_csv
 import llm_analyze_logs
 import extract_and_convert_logs
+import logset_db
+import cluster_templates
 from logger import log
 import time
 
+def tee_csv(rows, path, fieldnames):
+    """Pass rows through unchanged, writing a copy of each to a CSV on the way."""
+    with open(path, 'w', encoding='utf-8', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=fieldnames)
+        writer.writeheader()
+        for row in rows:
+            writer.writerow(row)
+            yield row
+
+def run_fused_steps(step1_path, step4_csv, step4_txt, step2_path=None, step3_path=None):
+    """
+    Steps 2-4 as one generator pipeline over the step 1 CSV: the file is
+    parsed once and only the deduplicated outputs are written, plus the
+    step 2/3 CSVs when their paths are given. Returns (total, unique, counts).
+    """
+    csv.field_size_limit(sys.maxsize)
+    with open(step1_path, 'r', encoding='utf-8', newline='') as f_in:
+        reader = csv.DictReader(f_in)
+        fieldnames = reader.fieldnames
+        if not fieldnames or 'text' not in fieldnames:
+            raise ValueError(f"Column 'text' not found in {step1_path}")
+        rows = extract_log_content.iter_extract(reader)
+        if step2_path:
+            rows = tee_csv(rows, step2_path, fieldnames)
+        counts = {}
+        rows = clean_log_text.iter_clean(rows, counts)
+        if step3_path:
+            rows = tee_csv(rows, step3_path, fieldnames)
+        total, unique = deduplicate_csv.write_unique(rows, fieldnames, step4_csv, step4_txt)
+    return total, unique, counts
+
 def main():
     log("Starting log processing pipeline...")
     timestamp = time.strftime("%Y%m%d_%H%M%S", time.localtime())
     # --- Configuration ---
     PROJECT = "media_hal"
     ROOT_DIR = "/home/bj17300-049u/work/mediahal_wraper/media_hal"
+    SCAN_JOBS = os.cpu_count() or 1  # processes used by step 1
+    # Step 1 manifest, kept across runs so unchanged files are not rescanned
+    SCAN_CACHE = os.path.join(current_dir, f"{PROJECT}_scan_cache.json")
+    # Set both to patch a previous step-1 CSV with only the files changed in
+    # git since GIT_SINCE (e.g. "HEAD~1"), instead of walking ROOT_DIR.
+    GIT_SINCE = ""
+    PREV_STEP_1 = ""
+    # Keep the logset in one SQLite database (FILE_DB) that steps 1-5 update
+    # in place, instead of a CSV per step. Step 4 still writes the txt for step 5.
+    USE_LOGSET_DB = False
+    # Run steps 2-4 as one streaming pass; KEEP_INTERMEDIATE also writes the
+    # step 2/3 CSVs as debug artifacts.
+    FUSED_STEPS = True
+    KEEP_INTERMEDIATE = False
+    # Step 4 keeps about this many MB of unique texts in memory before spilling to disk
+    deduplicate_csv.DEDUP_MEMORY_MB = 256
+    # Send one representative per cluster of near-identical templates to step 5
+    CLUSTER_TEMPLATES = True
+    CLUSTER_THRESHOLD = cluster_templates.THRESHOLD
+    # Step 5 batches in flight at once (keep <= OLLAMA_NUM_PARALLEL on the server)
+    LLM_PARALLEL = llm_analyze_logs.PARALLEL_BATCHES
+    # Step 5 options, the same as llm_analyze_logs' command line flags
+    LLM_OFFLINE_TOKENS = llm_analyze_logs.OFFLINE_TOKENS    # --offline-tokens
+    LLM_VERDICT_CACHE = llm_analyze_logs.VERDICT_CACHE      # --no-verdict-cache
+    LLM_STREAM = llm_analyze_logs.LLM_STREAM                # --no-stream
+    LLM_MAX_TOKENS = llm_analyze_logs.LLM_MAX_TOKENS        # --max-tokens
+    LLM_MAX_SECONDS = llm_analyze_logs.LLM_MAX_SECONDS      # --max-seconds
+    LLM_RULES = llm_analyze_logs.RULES                      # --no-rules
+    LLM_AUDIT_PERCENT = llm_analyze_logs.AUDIT_PERCENT      # --audit-percent
+    # Continue an interrupted step 5 from its journal (--resume). Unlike TAG the
+    # journal name is the same on every run: one per project and step 5 input.
+    LLM_RESUME = False
     TAG = f"{timestamp}_{PROJECT}_logset"
     os.makedirs(TAG, exist_ok=True)
     TAG = os.path.join(TAG, TAG)
     # Step 1 Output
     FILE_STEP_1 = os.path.join(current_dir, f"{TAG}.csv")
+    FILE_DB = os.path.join(current_dir, f"{TAG}.db")
     
     # Step 2 Output
     FILE_STEP_2 = os.path.join(current_dir, f"{TAG}_extracted.csv") 
@@ -38,60 +104,125 @@ def main():
     # Step 4 Output
     FILE_STEP_4_CSV = os.path.join(current_dir, f"{TAG}_deduplicated.csv")
     FILE_STEP_4_TXT = os.path.join(current_dir, f"{TAG}_deduplicated.txt")
+    FILE_STEP_4_REPS = os.path.join(current_dir, f"{TAG}_deduplicated_reps.txt")
+    FILE_STEP_4_CLUSTERS = os.path.join(current_dir, f"{TAG}_deduplicated_clusters.json")
     
     # Step 5 Output
     FILE_STEP_5 = os.path.join(current_dir, f"{TAG}_suspicious_analysis.txt")
     FILE_STEP_5_FAIL = os.path.join(current_dir, f"{TAG}_suspicious_analysis_fail.txt")
+    FILE_STEP_5_JOURNAL = os.path.join(
+        current_dir, f"{PROJECT}_suspicious_analysis{'_reps' if CLUSTER_TEMPLATES else ''}.journal")
     
     # Step 6 Output
     FILE_STEP_6_EXTRACTED = os.path.join(current_dir, f"{TAG}_extracted_contents.txt")
     FILE_STEP_6_REGEX = os.path.join(current_dir, f"{TAG}_extracted_contents_regex.txt")
 
     # --- Step 1: Extract Logs from Source ---
-    log(f"\n[Step 1] Extracting logs from {ROOT_DIR} to {FILE_STEP_1}...")
+    db = logset_db.open_logset(FILE_DB) if USE_LOGSET_DB else None
+    log(f"\n[Step 1] Extracting logs from {ROOT_DIR} to {FILE_DB if db else FILE_STEP_1}...")
     try:
         patterns, starters = extract_log.build_patterns()
-        rows = extract_log.walk_root(ROOT_DIR, patterns, starters)
-        extract_log.write_output(FILE_STEP_1, rows, "csv")
-        log(f"Step 1 Complete. Rows found: {len(rows)}")
+        scan_stats = extract_log.new_scan_stats()
+        if GIT_SINCE and PREV_STEP_1:
+            changed, deleted = extract_log.git_changed_files(ROOT_DIR, since=GIT_SINCE)
+            # Same ignore rules as the full walk below
+            changed, deleted = extract_log.filter_changed(ROOT_DIR, changed, deleted, scan_stats)
+            log(f"Git: {len(changed)} changed, {len(deleted)} deleted source files since {GIT_SINCE}")
+            rows = extract_log.iter_patched(PREV_STEP_1, changed, deleted, patterns, starters, SCAN_JOBS, scan_stats)
+        else:
+            rows = extract_log.iter_scan(ROOT_DIR, patterns, starters, SCAN_JOBS, SCAN_CACHE, scan_stats)
+        if db:
+            row_count = logset_db.load_rows(db, rows)
+        else:
+            row_count = extract_log.write_output(FILE_STEP_1, rows, "csv")
+        log(extract_log.format_scan_stats(scan_stats))
+        log(f"Step 1 Complete. Rows found: {row_count}")
     except Exception as e:
         log(f"Step 1 Failed: {e}")
         return
 
-    # --- Step 2: Extract Content (quoted strings) ---
-    log(f"\n[Step 2] Extracting quoted content to {FILE_STEP_2}...")
-    try:
-        extract_log_content.process_csv(FILE_STEP_1, FILE_STEP_2)
-        log("Step 2 Complete.")
-    except Exception as e:
-        log(f"Step 2 Failed: {e}")
-        return
+    if FUSED_STEPS and not db:
+        # --- Steps 2-4 fused: one pass over the step 1 CSV ---
+        log(f"\n[Steps 2-4] Extracting, cleaning and deduplicating {FILE_STEP_1} to {FILE_STEP_4_CSV} and {FILE_STEP_4_TXT}...")
+        try:
+            total, unique, counts = run_fused_steps(
+                FILE_STEP_1, FILE_STEP_4_CSV, FILE_STEP_4_TXT,
+                FILE_STEP_2 if KEEP_INTERMEDIATE else None,
+                FILE_STEP_3 if KEEP_INTERMEDIATE else None)
+            log(f"Rows: {total}, filtered by cleaning: {counts.get('filtered', 0)}, unique: {unique}")
+            log("Steps 2-4 Complete.")
+        except Exception as e:
+            log(f"Steps 2-4 Failed: {e}")
+            return
+    else:
+        # --- Step 2: Extract Content (quoted strings) ---
+        log(f"\n[Step 2] Extracting quoted content to {FILE_STEP_2}...")
+        try:
+            if db:
+                logset_db.apply_extract(db)
+            else:
+                extract_log_content.process_csv(FILE_STEP_1, FILE_STEP_2)
+            log("Step 2 Complete.")
+        except Exception as e:
+            log(f"Step 2 Failed: {e}")
+            return
 
-    # --- Step 3: Clean Text ---
-    log(f"\n[Step 3] Cleaning text to {FILE_STEP_3}...")
-    try:
-        clean_log_text.process_csv(FILE_STEP_2, FILE_STEP_3)
-        log("Step 3 Complete.")
-    except Exception as e:
-        log(f"Step 3 Failed: {e}")
-        return
+        # --- Step 3: Clean Text ---
+        log(f"\n[Step 3] Cleaning text to {FILE_STEP_3}...")
+        try:
+            if db:
+                logset_db.apply_clean(db)
+            else:
+                clean_log_text.process_csv(FILE_STEP_2, FILE_STEP_3)
+            log("Step 3 Complete.")
+        except Exception as e:
+            log(f"Step 3 Failed: {e}")
+            return
 
-    # --- Step 4: Deduplicate ---
-    log(f"\n[Step 4] Deduplicating to {FILE_STEP_4_CSV} and {FILE_STEP_4_TXT}...")
-    try:
-        deduplicate_csv.deduplicate_csv(FILE_STEP_3, FILE_STEP_4_CSV, FILE_STEP_4_TXT)
-        log("Step 4 Complete.")
-    except Exception as e:
-        log(f"Step 4 Failed: {e}")
-        return
+        # --- Step 4: Deduplicate ---
+        log(f"\n[Step 4] Deduplicating to {FILE_STEP_4_CSV} and {FILE_STEP_4_TXT}...")
+        try:
+            if db:
+                log(f"Unique rows: {logset_db.apply_dedup(db)}")
+                logset_db.export_templates(db, FILE_STEP_4_TXT)
+            else:
+                deduplicate_csv.deduplicate_csv(FILE_STEP_3, FILE_STEP_4_CSV, FILE_STEP_4_TXT)
+            log("Step 4 Complete.")
+        except Exception as e:
+            log(f"Step 4 Failed: {e}")
+            return
+
+    step5_input = FILE_STEP_4_TXT
+    if CLUSTER_TEMPLATES:
+        log(f"\n[Step 4b] Clustering near-duplicate templates to {FILE_STEP_4_REPS}...")
+        try:
+            templates, clusters = cluster_templates.cluster_file(
+                FILE_STEP_4_TXT, FILE_STEP_4_REPS, FILE_STEP_4_CLUSTERS, CLUSTER_THRESHOLD)
+            log(f"{templates} templates in {clusters} clusters")
+            step5_input = FILE_STEP_4_REPS
+            log("Step 4b Complete.")
+        except Exception as e:
+            log(f"Step 4b Failed: {e}")
+            return
 
     # --- Step 5: Analyze with Ollama ---
     log(f"\n[Step 5] Analyzing logs with Ollama to {FILE_STEP_5}...")
     try:
         # Monkey-patch configuration in llm_analyze_logs
-        llm_analyze_logs.INPUT_FILE = FILE_STEP_4_TXT
+        llm_analyze_logs.INPUT_FILE = step5_input
         llm_analyze_logs.OUTPUT_FILE = FILE_STEP_5
         llm_analyze_logs.OUTPUT_FAIL_FILE = FILE_STEP_5_FAIL
+        llm_analyze_logs.PARALLEL_BATCHES = LLM_PARALLEL
+        # main() takes its argparse defaults from these
+        llm_analyze_logs.OFFLINE_TOKENS = LLM_OFFLINE_TOKENS
+        llm_analyze_logs.VERDICT_CACHE = LLM_VERDICT_CACHE
+        llm_analyze_logs.LLM_STREAM = LLM_STREAM
+        llm_analyze_logs.LLM_MAX_TOKENS = LLM_MAX_TOKENS
+        llm_analyze_logs.LLM_MAX_SECONDS = LLM_MAX_SECONDS
+        llm_analyze_logs.RULES = LLM_RULES
+        llm_analyze_logs.AUDIT_PERCENT = LLM_AUDIT_PERCENT
+        llm_analyze_logs.RESUME = LLM_RESUME
+        llm_analyze_logs.JOURNAL_FILE = FILE_STEP_5_JOURNAL
         
         # Run main analysis
         # We need to reset argv so argparse doesn't pick up pipeline args if any
@@ -99,8 +230,23 @@ def main():
         sys.argv = [sys.argv[0]] 
         llm_analyze_logs.main()
         sys.argv = old_argv
+        if step5_input == FILE_STEP_4_REPS and os.path.exists(FILE_STEP_5):
+            added = cluster_templates.expand_report(FILE_STEP_5, FILE_STEP_4_CLUSTERS)
+            log(f"Expanded report with {added} cluster member entries")
+        if db and os.path.exists(FILE_STEP_5):
+            members_of = cluster_templates.load_clusters(FILE_STEP_4_CLUSTERS) \
+                if step5_input == FILE_STEP_4_REPS else None
+            answered = logset_db.answered_texts(step5_input, FILE_STEP_5_FAIL, members_of)
+            flagged = logset_db.record_verdicts(db, FILE_STEP_5, llm_analyze_logs.MODEL, answered)
+            log(f"Recorded {flagged} suspicious templates in {FILE_DB}")
         
         log("Step 5 Complete.")
+    except SystemExit:
+        # Interrupted; the journal keeps finished batches for LLM_RESUME
+        sys.argv = old_argv
+        if db:
+            db.close()
+        raise
     except Exception as e:
         log(f"Step 5 Failed: {e}")
         return
@@ -123,4 +269,9 @@ def main():
     log(f"Final Regex File: {FILE_STEP_6_REGEX}")
 
 if __name__ == "__main__":
-    main()
+    try:
+        main()
+    except SystemExit as e:
+        if e.code != llm_analyze_logs.INTERRUPTED_EXIT:
+            raise
+        llm_analyze_logs.leave_interrupted()
@@ -0,0 +1,186 @@
+import os
+import re
+import sys
+import json
+import math
+import random
+import argparse
+from logger import log
+
+# Offline token count: a linear model over character-class counts, fitted by
+# least squares against the remote /tokenize endpoint on a sample of lines.
+# The fitted weights and the error measured on held-out lines are kept in
+# ESTIMATOR_FILE; without it the (rough) default weights are used.
+ESTIMATOR_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "token_estimator.json")
+
+FEATURE_NAMES = ["words", "word_chars", "digits", "punct", "cjk", "other", "spaces"]
+FEATURE_RE = re.compile(r"(?P<word>[A-Za-z]+)|(?P<digits>[0-9]+)|(?P<space>\s+)|(?P<punct>[!-/:-@\[-`{-~]+)|(?P<cjk>[\u3000-\u9fff\uac00-\ud7af\uff00-\uffef]+)|(?P<other>.)", re.S)
+# Rough BPE-like weights, used until calibrate() has been run
+DEFAULT_WEIGHTS = [0.6, 0.12, 0.5, 0.8, 1.0, 1.0, 0.0]
+DEFAULT_INTERCEPT = 0.0
+DEFAULT_MARGIN = 0.25
+CALIBRATION_SAMPLE = 2000
+HOLDOUT = 0.2
+
+def features(text):
+    """[words, word_chars, digits, punct, cjk, other, spaces] counts for text."""
+    words = word_chars = digits = punct = cjk = other = spaces = 0
+    for m in FEATURE_RE.finditer(text):
+        kind = m.lastgroup
+        n = m.end() - m.start()
+        if kind == "word":
+            words += 1
+            word_chars += n
+        elif kind == "digits":
+            digits += n
+        elif kind == "space":
+            spaces += 1
+        elif kind == "punct":
+            punct += n
+        elif kind == "cjk":
+            cjk += n
+        else:
+            other += 1
+    return [words, word_chars, digits, punct, cjk, other, spaces]
+
+def _solve(a, b):
+    """Solve a x = b (a square) by Gaussian elimination with partial pivoting."""
+    n = len(b)
+    m = [row[:] + [b[i]] for i, row in enumerate(a)]
+    for col in range(n):
+        pivot = max(range(col, n), key=lambda r: abs(m[r][col]))
+        if abs(m[pivot][col]) < 1e-12:
+            continue
+        m[col], m[pivot] = m[pivot], m[col]
+        for r in range(n):
+            if r != col and m[r][col]:
+                f = m[r][col] / m[col][col]
+                for c in range(col, n + 1):
+                    m[r][c] -= f * m[col][c]
+    return [m[i][n] / m[i][i] if abs(m[i][i]) >= 1e-12 else 0.0 for i in range(n)]
+
+def least_squares(rows, targets, ridge=1e-6):
+    """Weights w (last one the intercept) minimizing |X w - y|^2 + ridge |w|^2."""
+    xs = [r + [1.0] for r in rows]
+    k = len(xs[0])
+    xtx = [[0.0] * k for _ in range(k)]
+    xty = [0.0] * k
+    for x, y in zip(xs, targets):
+        for i in range(k):
+            xi = x[i]
+            if not xi:
+                continue
+            xty[i] += xi * y
+            row = xtx[i]
+            for j in range(k):
+                row[j] += xi * x[j]
+    for i in range(k):
+        xtx[i][i] += ridge
+    return _solve(xtx, xty)
+
+class TokenEstimator:
+    def __init__(self, weights=None, intercept=DEFAULT_INTERCEPT, margin=DEFAULT_MARGIN, stats=None):
+        self.weights = list(weights or DEFAULT_WEIGHTS)
+        self.intercept = intercept
+        # upper() = estimate * (1 + margin); margin covers 95% of held-out lines
+        self.margin = margin
+        self.stats = stats or {}
+
+    @classmethod
+    def load(cls, path=ESTIMATOR_FILE):
+        """Calibrated estimator from path, or the default one if it does not exist."""
+        if path and os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            return cls(data["weights"], data["intercept"], data["margin"], data.get("stats"))
+        return cls()
+
+    def save(self, path=ESTIMATOR_FILE):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({"features": FEATURE_NAMES, "weights": self.weights, "intercept": self.intercept,
+                       "margin": self.margin, "stats": self.stats}, f, indent=1)
+
+    def raw(self, text):
+        return sum(w * x for w, x in zip(self.weights, features(text))) + self.intercept
+
+    def estimate(self, text):
+        """Best guess of the token count."""
+        return max(1, int(round(self.raw(text)))) if text else 0
+
+    def upper(self, text):
+        """Token count that 95% of lines stay under; use it to keep batches within a limit."""
+        return max(1, int(math.ceil(self.raw(text) * (1 + self.margin)))) if text else 0
+
+def error_stats(estimator, texts, actual):
+    """Held-out errors of estimator against the real counts."""
+    abs_err = []
+    ratios = []
+    for text, y in zip(texts, actual):
+        pred = max(estimator.raw(text), 1e-9)
+        abs_err.append(abs(y - pred))
+        ratios.append(y / pred - 1)
+    ratios.sort()
+    n = len(ratios)
+    total_actual = sum(actual)
+    total_pred = sum(estimator.raw(t) for t in texts)
+    return {
+        "lines": n,
+        "mean_abs_error": sum(abs_err) / n,
+        "max_abs_error": max(abs_err),
+        "p95_under_estimate": max(0.0, ratios[min(n - 1, int(0.95 * n))]),
+        "total_error": (total_pred - total_actual) / total_actual if total_actual else 0.0,
+    }
+
+def calibrate(texts, actual, holdout=HOLDOUT, seed=1):
+    """
+    Fit on (1 - holdout) of the sample, measure the error on the rest, then
+    refit on everything. Returns the estimator with its stats.
+    """
+    pairs = [(t, y) for t, y in zip(texts, actual) if t]
+    random.Random(seed).shuffle(pairs)
+    cut = max(1, int(len(pairs) * (1 - holdout)))
+    fit, test = pairs[:cut], pairs[cut:] or pairs[:cut]
+    w = least_squares([features(t) for t, _ in fit], [y for _, y in fit])
+    stats = error_stats(TokenEstimator(w[:-1], w[-1]), [t for t, _ in test], [y for _, y in test])
+    w = least_squares([features(t) for t, _ in pairs], [y for _, y in pairs])
+    stats["samples"] = len(pairs)
+    return TokenEstimator(w[:-1], w[-1], stats["p95_under_estimate"], stats)
+
+def format_stats(stats):
+    return (f"{stats['lines']} lines: mean abs error {stats['mean_abs_error']:.2f} tokens, "
+            f"max {stats['max_abs_error']:.1f}, total {stats['total_error'] * 100:+.1f}%, "
+            f"95% of lines within +{stats['p95_under_estimate'] * 100:.1f}% of the estimate")
+
+def main():
+    ap = argparse.ArgumentParser(description="Calibrate or check the offline token estimator.")
+    ap.add_argument("input", help="text file, one log per line (e.g. the step 4 txt)")
+    ap.add_argument("--calibrate", action="store_true", help="fit against the tokenizer API and save")
+    ap.add_argument("--sample", type=int, default=CALIBRATION_SAMPLE)
+    ap.add_argument("--url", default="", help="tokenizer URL (default: TokenSplitter's)")
+    ap.add_argument("--model", default=ESTIMATOR_FILE, help="estimator file")
+    args = ap.parse_args()
+
+    from token_splitter import TokenSplitter
+    with open(args.input, "r", encoding="utf-8") as f:
+        lines = list(dict.fromkeys(line.strip() for line in f if line.strip()))
+    if len(lines) > args.sample:
+        lines = random.Random(0).sample(lines, args.sample)
+    splitter = TokenSplitter(tokenizer_url=args.url) if args.url else TokenSplitter()
+    log(f"Counting {len(lines)} lines with {splitter.tokenizer_url}...")
+    actual = splitter.tokenize_batch(lines)
+    if splitter.api_down:
+        log("Tokenizer API unreachable, cannot calibrate.")
+        sys.exit(1)
+
+    if args.calibrate:
+        estimator = calibrate(lines, actual)
+        estimator.save(args.model)
+        log(f"Weights: {dict(zip(FEATURE_NAMES, (round(w, 4) for w in estimator.weights)))}, intercept {estimator.intercept:.3f}")
+        log("Held-out error: " + format_stats(estimator.stats))
+        log(f"Saved to {args.model}")
+    else:
+        estimator = TokenEstimator.load(args.model)
+        log("Error: " + format_stats(error_stats(estimator, lines, actual)))
+
+if __name__ == "__main__":
+    main()
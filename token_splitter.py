@@ -1,13 +1,95 @@
+import os
 import re
-import requests
 import json
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+import requests
 from logger import log
+import http_session
+from token_estimator import TokenEstimator, ESTIMATOR_FILE
+
+# Token counts from the tokenizer API are cached per (tokenizer_url, text hash):
+# in memory (LRU) and in this SQLite file, so re-runs need no tokenizer traffic.
+TOKEN_CACHE_DB = os.path.join(os.path.dirname(os.path.abspath(__file__)), "token_cache.db")
+LRU_SIZE = 100000
+# Texts per /tokenize request in tokenize_batch
+API_BATCH_SIZE = 256
+# Answers meaning the server does not take the {"texts": [...]} format;
+# anything else that fails is retried, then counted per text for that batch only.
+BATCH_UNSUPPORTED_STATUS = (400, 404, 405, 415, 422)
+BATCH_RETRIES = 1
+BATCH_UNSUPPORTED = "unsupported"
+
+def text_hash(text):
+    return hashlib.sha1(text.encode("utf-8", errors="surrogatepass")).hexdigest()
+
+class TokenCountCache:
+    """LRU in front of an optional SQLite table of (url, hash) -> token count."""
+    def __init__(self, db_path=TOKEN_CACHE_DB, lru_size=LRU_SIZE):
+        self.lru = OrderedDict()
+        self.lru_size = lru_size
+        self.lock = threading.Lock()
+        self.conn = None
+        if db_path:
+            self.conn = sqlite3.connect(db_path, check_same_thread=False)
+            self.conn.execute("""CREATE TABLE IF NOT EXISTS token_counts (
+                url TEXT NOT NULL, hash TEXT NOT NULL, count INTEGER NOT NULL,
+                PRIMARY KEY (url, hash))""")
+            self.conn.commit()
+
+    def _remember(self, key, count):
+        self.lru[key] = count
+        self.lru.move_to_end(key)
+        if len(self.lru) > self.lru_size:
+            self.lru.popitem(last=False)
+
+    def get_many(self, url, hashes):
+        """{hash: count} for the hashes found in memory or on disk."""
+        found = {}
+        with self.lock:
+            missing = []
+            for h in hashes:
+                count = self.lru.get((url, h))
+                if count is None:
+                    missing.append(h)
+                else:
+                    self.lru.move_to_end((url, h))
+                    found[h] = count
+            if self.conn and missing:
+                for start in range(0, len(missing), 500):
+                    part = missing[start:start + 500]
+                    sql = f"SELECT hash, count FROM token_counts WHERE url = ? AND hash IN ({','.join('?' * len(part))})"
+                    for h, count in self.conn.execute(sql, [url] + part):
+                        found[h] = count
+                        self._remember((url, h), count)
+        return found
+
+    def put_many(self, url, counts):
+        """counts: {hash: count}"""
+        with self.lock:
+            for h, count in counts.items():
+                self._remember((url, h), count)
+            if self.conn and counts:
+                self.conn.executemany("INSERT OR REPLACE INTO token_counts (url, hash, count) VALUES (?, ?, ?)",
+                                      [(url, h, c) for h, c in counts.items()])
+                self.conn.commit()
 
 class TokenSplitter:
-    def __init__(self, max_tokens=2048, overlap=50, tokenizer_url="http://10.58.11.60:1234/tokenize"):
+    def __init__(self, max_tokens=2048, overlap=50, tokenizer_url="http://10.58.11.60:1234/tokenize", timeout=10,
+                 cache_path=TOKEN_CACHE_DB, estimator_path=ESTIMATOR_FILE):
         self.max_tokens = max_tokens
         self.overlap = overlap
         self.tokenizer_url = tokenizer_url  # e.g., "http://10.58.11.60:1234/tokenize"
+        self.timeout = timeout
+        # cache_path=None keeps the cache in memory only
+        self.cache = TokenCountCache(cache_path)
+        # Cleared after the first batch request the server rejects
+        self.batch_api = True
+        # Offline estimate, used when there is no tokenizer or it is unreachable
+        self.estimator = TokenEstimator.load(estimator_path)
+        self.api_down = False
 
     def tokenize_regex(self, text):
         """
@@ -28,20 +110,41 @@ class TokenSplitter:
         print(ret, len(ret))
         return len(ret)
 
+    def tokenize_local(self, text):
+        """Token count from the calibrated offline estimator (no network)."""
+        return self.estimator.estimate(text)
+
+    def _mark_down(self, e):
+        if http_session.is_unreachable(e) and not self.api_down:
+            log(f"Tokenizer {self.tokenizer_url} unreachable ({e}), using the offline estimate")
+            self.api_down = True
+
     def tokenize_api(self, text):
         """
         Uses an external API to tokenize text.
         """
-        if not self.tokenizer_url:
-            return len(self.tokenize_regex(text))
+        if not self.tokenizer_url or self.api_down:
+            return self.tokenize_local(text)
 
+        h = text_hash(text)
+        cached = self.cache.get_many(self.tokenizer_url, [h])
+        if h in cached:
+            return cached[h]
+        count = self._post_one(text)
+        if count is not None:
+            self.cache.put_many(self.tokenizer_url, {h: count})
+            return count
+        return self.tokenize_local(text)
+
+    def _post_one(self, text):
+        """Token count of one text from the API, or None if the call failed."""
         try:
             payload = {
                 "text": text,
                 "include_special_tokens": False
             }
             headers = {"Content-Type": "application/json"}
-            response = requests.post(self.tokenizer_url, json=payload, headers=headers, timeout=10)
+            response = http_session.post(self.tokenizer_url, json=payload, headers=headers, read_timeout=self.timeout)
             if response.status_code == 200:
                 result = response.json()
                 # Assuming the API returns a list of token IDs in "tokens"
@@ -52,10 +155,85 @@ class TokenSplitter:
                 return 0
             else:
                 print(f"Error calling tokenizer API: {response.status_code}")
-                return len(self.tokenize_regex(text))
+                return None
         except Exception as e:
             print(f"Exception calling tokenizer API: {e}")
-            return len(self.tokenize_regex(text))
+            self._mark_down(e)
+            return None
+
+    def _post_batch(self, texts):
+        """
+        Token counts of many texts in one request ({"texts": [...]} ->
+        {"token_counts": [...]}). Returns BATCH_UNSUPPORTED if the server
+        does not take that format, None if the request failed otherwise.
+        """
+        try:
+            payload = {
+                "texts": texts,
+                "include_special_tokens": False
+            }
+            response = http_session.post(self.tokenizer_url, json=payload, read_timeout=self.timeout * 10)
+            if response.status_code in BATCH_UNSUPPORTED_STATUS:
+                return BATCH_UNSUPPORTED
+            if response.status_code == 200:
+                counts = response.json().get("token_counts")
+                if isinstance(counts, list) and len(counts) == len(texts):
+                    return counts
+                # Answered, but not in the batch format
+                return BATCH_UNSUPPORTED
+            print(f"Error calling tokenizer API (batch): {response.status_code}")
+        except Exception as e:
+            print(f"Exception calling tokenizer API (batch): {e}")
+            # A slow answer to a big batch does not mean the server is down
+            if not isinstance(e, requests.ReadTimeout):
+                self._mark_down(e)
+        return None
+
+    def tokenize_batch(self, texts):
+        """
+        Token counts for a list of texts: cached counts first, the rest in
+        API_BATCH_SIZE requests, falling back to one request per text when
+        the server has no batch support (from then on) or a batch keeps
+        failing (for that batch). Texts the API could not count get the
+        offline estimate.
+        """
+        if not self.tokenizer_url or self.api_down:
+            return [self.tokenize_local(t) for t in texts]
+        url = self.tokenizer_url
+        hashes = [text_hash(t) for t in texts]
+        counts = self.cache.get_many(url, list(set(hashes)))
+        todo = {}
+        for h, t in zip(hashes, texts):
+            if h not in counts:
+                todo.setdefault(h, t)
+        todo = list(todo.items())
+        for start in range(0, len(todo), API_BATCH_SIZE):
+            if self.api_down:
+                break
+            part = todo[start:start + API_BATCH_SIZE]
+            result = None
+            if self.batch_api:
+                for attempt in range(1 + BATCH_RETRIES):
+                    result = self._post_batch([t for _, t in part])
+                    if result is not None or self.api_down:
+                        break
+                if result == BATCH_UNSUPPORTED:
+                    log("Tokenizer has no batch support, counting one text per request")
+                    self.batch_api = False
+                    result = None
+            if result is None:
+                new = {}
+                for h, t in part:
+                    if self.api_down:
+                        break
+                    count = self._post_one(t)
+                    if count is not None:
+                        new[h] = count
+            else:
+                new = {h: c for (h, _), c in zip(part, result)}
+            self.cache.put_many(url, new)
+            counts.update(new)
+        return [counts[h] if h in counts else self.tokenize_local(t) for h, t in zip(hashes, texts)]
 
     def tokenize(self, text):
         return self.tokenize_regex(text)
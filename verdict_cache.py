@@ -0,0 +1,129 @@
+import os
+import re
+import time
+import sqlite3
+import hashlib
+import argparse
+from logger import log
+
+# LLM verdicts of step 5, kept across runs and logsets. A verdict is reused
+# only for the same model, the same prompt template (and options) and the
+# same log text up to whitespace, so changing any of them re-asks the model.
+VERDICT_CACHE_DB = os.path.join(os.path.dirname(os.path.abspath(__file__)), "verdict_cache.db")
+
+SUSPICIOUS = "SUSPICIOUS"
+CLEAN = "CLEAN"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS verdicts (
+    model       TEXT NOT NULL,
+    prompt_hash TEXT NOT NULL,
+    text_hash   TEXT NOT NULL,
+    text        TEXT NOT NULL,
+    verdict     TEXT NOT NULL,
+    reason      TEXT,
+    created     REAL NOT NULL,
+    PRIMARY KEY (model, prompt_hash, text_hash)
+);
+"""
+SPACE_RE = re.compile(r"\s+")
+
+def normalize(text):
+    return SPACE_RE.sub(" ", text).strip()
+
+def _hash(text):
+    return hashlib.sha1(text.encode("utf-8", errors="surrogatepass")).hexdigest()
+
+def prompt_hash(template, *extra):
+    """Hash of the prompt template plus anything else that changes answers (e.g. options)."""
+    return _hash("\0".join([template] + [str(e) for e in extra]))[:16]
+
+class VerdictCache:
+    def __init__(self, db_path=VERDICT_CACHE_DB, model="", prompt_hash=""):
+        self.conn = sqlite3.connect(db_path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript(SCHEMA)
+        self.model = model
+        self.prompt_hash = prompt_hash
+        self.stats = {"hits": 0, "misses": 0, "stored": 0}
+
+    def get_many(self, texts):
+        """{text: (verdict, reason)} for the texts with a cached verdict; counts hits/misses."""
+        keys = {}
+        for t in texts:
+            keys.setdefault(_hash(normalize(t)), []).append(t)
+        found = {}
+        hashes = list(keys)
+        for start in range(0, len(hashes), 500):
+            part = hashes[start:start + 500]
+            sql = (f"SELECT text_hash, verdict, reason FROM verdicts WHERE model = ? AND prompt_hash = ? "
+                   f"AND text_hash IN ({','.join('?' * len(part))})")
+            for h, verdict, reason in self.conn.execute(sql, [self.model, self.prompt_hash] + part):
+                for t in keys[h]:
+                    found[t] = (verdict, reason)
+        self.stats["hits"] += len(found)
+        self.stats["misses"] += len(texts) - len(found)
+        return found
+
+    def put_many(self, verdicts):
+        """verdicts: [(text, verdict, reason)]"""
+        now = time.time()
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO verdicts (model, prompt_hash, text_hash, text, verdict, reason, created) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [(self.model, self.prompt_hash, _hash(normalize(t)), normalize(t), v, r, now) for t, v, r in verdicts])
+        self.conn.commit()
+        self.stats["stored"] += len(verdicts)
+
+    def format_stats(self):
+        looked_up = self.stats["hits"] + self.stats["misses"]
+        rate = self.stats["hits"] / looked_up * 100 if looked_up else 0.0
+        return (f"Verdict cache: {self.stats['hits']} hits, {self.stats['misses']} misses "
+                f"({rate:.1f}% hit rate), {self.stats['stored']} stored")
+
+def summary(conn):
+    """[(model, prompt_hash, verdicts, suspicious)]"""
+    return conn.execute("SELECT model, prompt_hash, COUNT(*), SUM(verdict = ?) FROM verdicts "
+                        "GROUP BY model, prompt_hash ORDER BY model, prompt_hash", (SUSPICIOUS,)).fetchall()
+
+def invalidate(conn, model=None, prompt=None, text=None):
+    """Delete cached verdicts matching all the given filters; returns the count."""
+    sql = ["DELETE FROM verdicts WHERE 1 = 1"]
+    params = []
+    if model:
+        sql.append("AND model = ?")
+        params.append(model)
+    if prompt:
+        sql.append("AND prompt_hash = ?")
+        params.append(prompt)
+    if text:
+        sql.append("AND text_hash = ?")
+        params.append(_hash(normalize(text)))
+    count = conn.execute(" ".join(sql), params).rowcount
+    conn.commit()
+    return count
+
+def main():
+    ap = argparse.ArgumentParser(description="Inspect or invalidate the LLM verdict cache.")
+    ap.add_argument("--db", default=VERDICT_CACHE_DB)
+    ap.add_argument("--invalidate", action="store_true", help="delete the verdicts matching the filters below")
+    ap.add_argument("--all", action="store_true", help="with --invalidate and no filters: delete everything")
+    ap.add_argument("--model", default="")
+    ap.add_argument("--prompt-hash", default="")
+    ap.add_argument("--text", default="", help="one log text")
+    args = ap.parse_args()
+    if not os.path.exists(args.db):
+        log(f"Cache not found: {args.db}")
+        return
+    conn = sqlite3.connect(args.db)
+    if args.invalidate:
+        if not (args.model or args.prompt_hash or args.text or args.all):
+            log("Refusing to delete every verdict without --all.")
+            return
+        log(f"Deleted {invalidate(conn, args.model, args.prompt_hash, args.text)} verdicts")
+        return
+    for model, prompt, count, suspicious in summary(conn):
+        log(f"{model}\tprompt {prompt}\t{count} verdicts\t{suspicious} suspicious")
+
+if __name__ == "__main__":
+    main()